@@ -1,415 +1,2071 @@
+import abc
+import base64
+import csv
+import gzip
+import io
 import json
 import os
+import hashlib
+import logging
+import re
+import sys
+import select
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from typing import Dict, Any
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
+from typing import Dict, Any, List, Optional
 import urllib.request
 import urllib.error
 
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+OPENAI_API_URL = os.environ.get('OPENAI_API_URL', 'https://api.openai.com/v1/chat/completions')
+AI_SYSTEM_PROMPT = 'Ты - Chattik AI, дружелюбный помощник в мессенджере Chattik. Отвечай кратко, по-дружески и на русском языке.'
+AI_ERROR_REPLY = 'Извините, произошла ошибка. Попробуйте позже.'
+AI_REQUEST_TIMEOUT = float(os.environ.get('AI_REQUEST_TIMEOUT', '20'))
+AI_WORKER_CONCURRENCY = int(os.environ.get('AI_WORKER_CONCURRENCY', '4'))
+AI_JOB_MAX_ATTEMPTS = 3
+AI_CONTEXT_MESSAGES = int(os.environ.get('AI_CONTEXT_MESSAGES', '20'))
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get('AI_CONTEXT_TOKEN_BUDGET', '2000'))
+AI_CACHE_SIZE = int(os.environ.get('AI_CACHE_SIZE', '512'))
+AI_CACHE_TTL_SECONDS = float(os.environ.get('AI_CACHE_TTL_SECONDS', '3600'))
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL_SECONDS = float(os.environ.get('PROFILE_CACHE_TTL_SECONDS', '300'))
+MEMBERSHIP_CACHE_TTL_SECONDS = float(os.environ.get('MEMBERSHIP_CACHE_TTL_SECONDS', '60'))
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+# Не меньше секунды: при нулевой аренде задание тут же забрал бы другой обработчик, а ответ первого отбросила бы проверка attempts
+AI_JOB_LEASE_SECONDS = max(AI_REQUEST_TIMEOUT * 2, 1.0)
+AI_POLL_DRAIN_MAX_JOBS = int(os.environ.get('AI_POLL_DRAIN_MAX_JOBS', '1'))
+
+MEMBERS_INSERT_PAGE_SIZE = 1000
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_SIZE_MAX = 200
+LONG_POLL_TIMEOUT_MAX = 25.0
+
+CONTACTS_PAGE_SIZE = 200
+CONTACTS_PAGE_SIZE_MAX = 500
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 100
+
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_CHECK_INTERVAL = 6 * 3600
+MESSAGES_ARCHIVE_DIR = os.environ.get('MESSAGES_ARCHIVE_DIR', '/tmp/messages_archive')
+
+BATCH_MAX_REQUESTS = 20
+BATCH_EXCLUDED_PATHS = ('poll', 'metrics')
+BATCH_EXCLUDED_ACTIONS = ('batch', 'process_ai_jobs', 'flush_presence', 'maintain_partitions', 'import_messages')
+
+SYNC_MESSAGES_LIMIT = int(os.environ.get('SYNC_MESSAGES_LIMIT', '500'))
+MEMBERSHIP_TABLES = ('chat_members', 'chat_participants')
+
+IMPORT_MAX_ROWS = int(os.environ.get('IMPORT_MAX_ROWS', '500000'))
+IMPORT_CHUNK_ROWS = int(os.environ.get('IMPORT_CHUNK_ROWS', '20000'))
+IMPORT_FUTURE_TOLERANCE = timedelta(days=1)
+IMPORT_COLUMNS = ('chat_id', 'sender_id', 'content', 'is_ai', 'created_at',
+                  'attachment_url', 'attachment_type', 'attachment_name', 'attachment_size')
+IMPORT_NULLABLE_COLUMNS = ('sender_id', 'attachment_url', 'attachment_type', 'attachment_name', 'attachment_size')
+
+PRESENCE_COALESCE_SECONDS = float(os.environ.get('PRESENCE_COALESCE_SECONDS', '60'))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '60'))
+PRESENCE_FLUSH_LOCK_ID = 7301
+PRESENCE_TRACKED_USERS_MAX = 100000
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', '10'))
+DB_POOL_IDLE_CHECK_SECONDS = float(os.environ.get('DB_POOL_IDLE_CHECK_SECONDS', '30'))
+
+METRICS_LOG_ENABLED = os.environ.get('METRICS_LOG_ENABLED', '') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '200'))
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Метка route берётся только из известных значений, иначе произвольный ?path= плодил бы серии метрик
+METRICS_GET_PATHS = ('chats', 'contacts', 'sync', 'messages', 'poll', 'search_messages', 'metrics', 'cache_stats', 'search_user')
+METRICS_POST_ACTIONS = ('register', 'send_message', 'create_chat', 'add_contact', 'update_online_status', 'update_status',
+                        'flush_presence', 'mark_read', 'create_group', 'ai_response', 'batch', 'import_messages',
+                        'maintain_partitions', 'process_ai_jobs')
+
+logger = logging.getLogger('chattix.api')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def log_event(event: str, level: int = logging.INFO, **fields: Any) -> None:
+    logger.log(level, json.dumps(dict(fields, event=event), ensure_ascii=False, default=str))
+
+class MetricsRegistry:
+    '''
+    Гистограммы задержек и счётчики процесса в формате Prometheus.
+    Ключ серии — имя метрики и отсортированный набор меток.
+    '''
+    
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._histograms: Dict[tuple, List[float]] = {}
+        self._counters: Dict[tuple, float] = defaultdict(float)
+        self._help: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+    
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += amount
+    
+    def render(self, extra: Dict[str, float]) -> str:
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        
+        seen = set()
+        for (name, labels), series in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', repr(bound)),))} {count:g}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {series[-2]:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {series[-2]:g}")
+            lines.append(f"{name}_sum{format_labels(labels)} {series[-1]:.6f}")
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for name, value in sorted(extra.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = ','.join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in labels)
+    return '{' + escaped + '}'
+
+metrics = MetricsRegistry(LATENCY_BUCKETS)
+_request_context = threading.local()
+
+def current_route() -> str:
+    return getattr(_request_context, 'route', 'background')
+
+def record_query(query: Any, duration: float, rowcount: int) -> None:
+    text = query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+    statement = text.lstrip().split(None, 1)[0].upper() if text.strip() else 'UNKNOWN'
+    route = current_route()
+    metrics.observe('chattix_sql_duration_seconds', duration, route=route, statement=statement)
+    if rowcount > 0:
+        metrics.inc('chattix_sql_rows_total', rowcount, route=route, statement=statement)
+    if duration * 1000 >= SLOW_QUERY_MS:
+        log_event('slow_query', logging.WARNING, route=route, duration_ms=round(duration * 1000, 1),
+                  rows=rowcount, query=' '.join(text.split())[:500])
+
+_instrumented_cursors: Dict[type, type] = {}
+
+def instrumented_cursor_class(base: type) -> type:
+    '''
+    Подкласс курсора, замеряющий каждый execute/copy_expert (в т.ч. вызовы из execute_values).
+    '''
+    cls = _instrumented_cursors.get(base)
+    if cls is not None:
+        return cls
+    
+    class InstrumentedCursor(base):
+        def execute(self, query, vars=None):
+            started = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                record_query(query, time.perf_counter() - started, self.rowcount)
+        
+        def copy_expert(self, sql, file, size=8192):
+            started = time.perf_counter()
+            try:
+                return super().copy_expert(sql, file, size)
+            finally:
+                record_query(sql, time.perf_counter() - started, self.rowcount)
+    
+    _instrumented_cursors[base] = InstrumentedCursor
+    return InstrumentedCursor
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.pop('cursor_factory', None) or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = instrumented_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+def metrics_route(method: str, params: Dict[str, Any], body_data: Dict[str, Any]) -> str:
+    if method == 'GET':
+        name = params.get('path')
+        known = METRICS_GET_PATHS
+    elif method == 'POST':
+        name = body_data.get('action')
+        known = METRICS_POST_ACTIONS
+    else:
+        return 'OTHER unknown'
+    return f"{method} {name if name in known else 'unknown'}"
+
+def instrumented_route(func):
+    '''
+    Замеряет обработку маршрута (метод + path/action) и пишет структурированную строку лога, если включено.
+    '''
+    @wraps(func)
+    def wrapper(conn, schema, method, params, body_data, user_id):
+        route = metrics_route(method, params, body_data)
+        previous = getattr(_request_context, 'route', None)
+        _request_context.route = route
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = func(conn, schema, method, params, body_data, user_id)
+            status = response['statusCode']
+            return response
+        finally:
+            duration = time.perf_counter() - started
+            metrics.observe('chattix_request_duration_seconds', duration, route=route)
+            metrics.inc('chattix_requests_total', route=route, status=str(status))
+            if METRICS_LOG_ENABLED:
+                log_event('request', route=route, status=status, duration_ms=round(duration * 1000, 1))
+            _request_context.route = previous
+    return wrapper
+
+class ConnectionPool:
+    '''
+    Пул соединений с Postgres, переживающий тёплые вызовы функции.
+    Соединения, простоявшие дольше DB_POOL_IDLE_CHECK_SECONDS, проверяются через SELECT 1 перед выдачей.
+    '''
+    
+    def __init__(self, dsn: str, max_size: int, wait_timeout: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.wait_timeout = wait_timeout
+        self.schema: Optional[str] = None
+        self.stats: Dict[str, float] = {'hits': 0, 'misses': 0, 'waits': 0, 'wait_time_ms': 0.0, 'discarded': 0}
+        self._idle: List[tuple] = []
+        self._size = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self):
+        started = time.monotonic()
+        deadline = started + self.wait_timeout
+        waited = False
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['waits'] += 1
+                        self.stats['wait_time_ms'] += (time.monotonic() - started) * 1000
+                        raise TimeoutError('Database connection pool exhausted')
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                else:
+                    self._size += 1
+            
+            if waited:
+                self.stats['waits'] += 1
+                self.stats['wait_time_ms'] += (time.monotonic() - started) * 1000
+                waited = False
+            
+            if conn is None:
+                try:
+                    conn = psycopg2.connect(self.dsn, connection_factory=InstrumentedConnection)
+                except Exception:
+                    self._forget()
+                    raise
+                self.stats['misses'] += 1
+                return conn
+            
+            if self._is_healthy(conn, released_at):
+                self.stats['hits'] += 1
+                return conn
+            self._discard(conn)
+    
+    def release(self, conn) -> None:
+        if conn.closed:
+            self._forget()
+            return
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except Exception:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+    
+    def get_schema(self, conn) -> str:
+        if self.schema is None:
+            with conn.cursor() as cur:
+                cur.execute("SELECT current_schema()")
+                self.schema = cur.fetchone()[0]
+            conn.commit()
+        return self.schema
+    
+    def _is_healthy(self, conn, released_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < DB_POOL_IDLE_CHECK_SECONDS:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.stats['discarded'] += 1
+        self._forget()
+    
+    def _forget(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+class LRUCache:
+    '''
+    Потокобезопасный LRU-кэш с ограничением по размеру и времени жизни записей.
+    '''
+    
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.stats: Dict[str, int] = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return item[0]
+    
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.stats['evictions'] += 1
+    
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+    
+    def hit_rate(self) -> float:
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+ai_response_cache = LRUCache(AI_CACHE_SIZE, AI_CACHE_TTL_SECONDS)
+
+class SharedCacheBackend(abc.ABC):
+    '''
+    Интерфейс общего для всех экземпляров функции кэша, который использует ReadThroughCache.
+    Значения — строки JSON; get возвращает None для отсутствующего или просроченного ключа.
+    '''
+    
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+    
+    @abc.abstractmethod
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        ...
+    
+    @abc.abstractmethod
+    def delete(self, keys: List[str]) -> None:
+        ...
+
+class RedisCacheBackend(SharedCacheBackend):
+    '''
+    Общий кэш в Redis (CACHE_REDIS_URL).
+    '''
+    
+    def __init__(self, url: str):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.2)
+    
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+    
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        self.client.set(key, value, ex=max(int(ttl_seconds), 1))
+    
+    def delete(self, keys: List[str]) -> None:
+        if keys:
+            self.client.delete(*keys)
+
+class LocalCacheBackend(SharedCacheBackend):
+    '''
+    Замена RedisCacheBackend в пределах одного процесса: словарь с временем жизни записей.
+    В тестах его делят несколько ReadThroughCache, изображая разные экземпляры функции.
+    '''
+    
+    def __init__(self):
+        self._items: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] < time.monotonic():
+                self._items.pop(key, None)
+                return None
+            return item[0]
+    
+    def set(self, key: str, value: str, ttl_seconds: float) -> None:
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + ttl_seconds)
+    
+    def delete(self, keys: List[str]) -> None:
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+
+shared_cache_backend: Optional[SharedCacheBackend] = RedisCacheBackend(CACHE_REDIS_URL) if CACHE_REDIS_URL else None
+
+class ReadThroughCache:
+    '''
+    Read-through кэш: локальный LRUCache процесса, затем общий backend (если настроен), затем loader из БД.
+    Ошибки общего backend не ломают запрос — он просто пропускается.
+    '''
+    
+    def __init__(self, namespace: str, max_size: int, ttl_seconds: float):
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.local = LRUCache(max_size, ttl_seconds)
+        self.stats: Dict[str, int] = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+    
+    def get_many(self, keys: List[Any], loader) -> Dict[Any, Any]:
+        found: Dict[Any, Any] = {}
+        missing = []
+        for key in unique_ids(keys):
+            value = self.local.get(str(key))
+            if value is not None:
+                found[key] = value
+                self.stats['hits'] += 1
+                continue
+            value = self._shared_get(key)
+            if value is not None:
+                self.local.set(str(key), value)
+                found[key] = value
+                self.stats['shared_hits'] += 1
+                continue
+            missing.append(key)
+        
+        if missing:
+            self.stats['misses'] += len(missing)
+            for key, value in loader(missing).items():
+                self.local.set(str(key), value)
+                self._shared_set(key, value)
+                found[key] = value
+        return found
+    
+    def get(self, key: Any, loader) -> Any:
+        def load_one(keys):
+            value = loader(keys[0])
+            return {keys[0]: value} if value is not None else {}
+        return self.get_many([key], load_one).get(key)
+    
+    def invalidate(self, keys: List[Any]) -> None:
+        for key in keys:
+            self.local.delete(str(key))
+        if shared_cache_backend is not None:
+            try:
+                shared_cache_backend.delete([f"{self.namespace}:{key}" for key in keys])
+            except Exception:
+                pass
+    
+    def _shared_get(self, key: Any) -> Any:
+        if shared_cache_backend is None:
+            return None
+        try:
+            value = shared_cache_backend.get(f"{self.namespace}:{key}")
+        except Exception:
+            return None
+        return json.loads(value) if value is not None else None
+    
+    def _shared_set(self, key: Any, value: Any) -> None:
+        if shared_cache_backend is None:
+            return
+        try:
+            shared_cache_backend.set(f"{self.namespace}:{key}", json.dumps(value), self.ttl_seconds)
+        except Exception:
+            pass
+
+profile_cache = ReadThroughCache('profile', PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
+phone_cache = ReadThroughCache('phone', PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL_SECONDS)
+membership_cache = ReadThroughCache('membership', PROFILE_CACHE_SIZE, MEMBERSHIP_CACHE_TTL_SECONDS)
+
+def get_user_profiles(cur, schema: str, user_ids: List[Any]) -> Dict[Any, Dict[str, Any]]:
+    def load(ids):
+        cur.execute(f"SELECT id, name, phone, avatar FROM {schema}.users WHERE id = ANY(%s)", (list(ids),))
+        return {row['id']: dict(row) for row in cur.fetchall()}
+    return profile_cache.get_many([int(i) for i in user_ids if i is not None], load)
+
+def get_user_by_phone(cur, schema: str, phone: str) -> Optional[Dict[str, Any]]:
+    def load(key):
+        cur.execute(f"SELECT id, name, phone, avatar FROM {schema}.users WHERE phone = %s", (key,))
+        row = cur.fetchone()
+        return dict(row) if row else None
+    return phone_cache.get(phone, load)
+
+def get_user_chat_ids(cur, schema: str, user_id: Any) -> List[int]:
+    def load(key):
+        cur.execute(f"SELECT chat_id FROM {schema}.chat_memberships WHERE user_id = %s", (key,))
+        return [row['chat_id'] for row in cur.fetchall()]
+    return membership_cache.get(int(user_id), load) or []
+
+def invalidate_users(user_ids: List[Any], phones: Optional[List[str]] = None) -> None:
+    ids = [int(i) for i in user_ids if i is not None]
+    profile_cache.invalidate(ids)
+    membership_cache.invalidate(ids)
+    if phones:
+        phone_cache.invalidate(phones)
+
+_db_pool: Optional[ConnectionPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> ConnectionPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(os.environ['DATABASE_URL'], DB_POOL_MAX_SIZE, DB_POOL_WAIT_TIMEOUT)
+    return _db_pool
 
 def get_db_connection():
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
-    with conn.cursor() as cur:
-        cur.execute("SELECT current_schema()")
-        schema = cur.fetchone()[0]
+    pool = get_db_pool()
+    started = time.perf_counter()
+    conn = pool.acquire()
+    metrics.observe('chattix_db_acquire_seconds', time.perf_counter() - started)
+    try:
+        schema = pool.get_schema(conn)
+    except Exception:
+        pool.release(conn)
+        raise
     return conn, schema
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+def release_db_connection(conn) -> None:
+    get_db_pool().release(conn)
+
+def parse_int_param(value: Optional[str]) -> Optional[int]:
+    if value is None or value == '':
+        return None
+    return int(value)
+
+def encode_cursor(value: Any) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value, ensure_ascii=False).encode('utf-8')).decode('ascii')
+
+def decode_cursor(value: Optional[str]) -> Any:
+    if value is None or value == '':
+        return None
+    try:
+        return json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def decode_keyset_cursor(value: Optional[str], key_type: Any) -> Optional[List[Any]]:
     '''
-    Business: API для работы с чатами, сообщениями, контактами
-    Args: event с httpMethod, body, queryStringParameters
-    Returns: HTTP response с данными из базы
+    Курсор keyset-пагинации вида [ключ сортировки, id]; всё остальное — ValueError.
     '''
-    method: str = event.get('httpMethod', 'GET')
+    cursor = decode_cursor(value)
+    if cursor is None:
+        return None
+    if not (isinstance(cursor, list) and len(cursor) == 2
+            and isinstance(cursor[0], key_type) and isinstance(cursor[1], int)):
+        raise ValueError('Invalid cursor')
+    return cursor
+
+def parse_page_size(value: Optional[str], default: int, maximum: int) -> int:
+    limit = parse_int_param(value)
+    if limit is None:
+        return default
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+presence_stats: Dict[str, int] = {'heartbeats': 0, 'absorbed': 0, 'written': 0, 'flushed': 0}
+_presence_written: Dict[Any, tuple] = {}
+_presence_lock = threading.Lock()
+_presence_last_flush = time.monotonic()
+
+def record_heartbeat(conn, schema: str, user_id: Any, is_online: bool) -> None:
+    '''
+    Пишет присутствие в unlogged-таблицу user_presence вместо users.
+    Повторные heartbeat с тем же статусом в пределах PRESENCE_COALESCE_SECONDS поглощаются в памяти процесса;
+    смена статуса пишется всегда. last_seen в users переносится пачкой через flush_presence.
+    '''
+    global _presence_last_flush
+    now = time.monotonic()
+    with _presence_lock:
+        presence_stats['heartbeats'] += 1
+        last = _presence_written.get(user_id)
+        if last is not None and last[1] == is_online and now - last[0] < PRESENCE_COALESCE_SECONDS:
+            presence_stats['absorbed'] += 1
+            return
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {schema}.user_presence (user_id, is_online, last_heartbeat, dirty)
+            VALUES (%s, %s, NOW(), true)
+            ON CONFLICT (user_id) DO UPDATE SET
+                is_online = EXCLUDED.is_online, last_heartbeat = EXCLUDED.last_heartbeat, dirty = true
+        """, (user_id, is_online))
+    conn.commit()
     
-    headers = event.get('headers', {})
-    user_id = headers.get('x-user-id') or headers.get('X-User-Id')
-    params = event.get('queryStringParameters', {}) or {}
-    path = params.get('path', '')
+    with _presence_lock:
+        presence_stats['written'] += 1
+        _presence_written[user_id] = (now, is_online)
+        if len(_presence_written) > PRESENCE_TRACKED_USERS_MAX:
+            _presence_written.clear()
+        flush_due = now - _presence_last_flush >= PRESENCE_FLUSH_INTERVAL
+        if flush_due:
+            _presence_last_flush = now
     
-    conn, schema = get_db_connection()
+    if flush_due:
+        flush_presence(conn, schema)
+
+def flush_presence(conn, schema: str) -> int:
+    '''
+    Переносит изменившееся присутствие в users одним UPDATE.
+    Advisory-lock не даёт нескольким экземплярам функции сбрасывать одновременно.
+    '''
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (PRESENCE_FLUSH_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            conn.rollback()
+            return 0
+        cur.execute(f"""
+            WITH flushed AS (
+                UPDATE {schema}.user_presence SET dirty = false
+                WHERE dirty
+                RETURNING user_id, is_online, last_heartbeat
+            )
+            UPDATE {schema}.users u
+            SET is_online = f.is_online, last_seen = f.last_heartbeat, change_xid = pg_current_xact_id()
+            FROM flushed f
+            WHERE u.id = f.user_id
+        """)
+        flushed = cur.rowcount
+    conn.commit()
+    with _presence_lock:
+        presence_stats['flushed'] += flushed
+    return flushed
+
+def add_sender_profiles(cur, schema: str, messages: List[Dict[str, Any]]) -> None:
+    profiles = get_user_profiles(cur, schema, [msg['sender_id'] for msg in messages])
+    for msg in messages:
+        profile = profiles.get(msg['sender_id']) or {}
+        msg['sender_name'] = profile.get('name')
+        msg['sender_avatar'] = profile.get('avatar')
+        if msg['created_at']:
+            msg['created_at'] = msg['created_at'].isoformat()
+
+def fetch_messages_page(cur, schema: str, chat_id: Any, before_id: Optional[int], after_id: Optional[int], limit: int) -> tuple:
+    '''
+    Страница сообщений чата по курсору (created_at, id), всегда в порядке от старых к новым.
+    after_id = 0 означает «с самого начала чата». created_at курсора подставляется константой,
+    чтобы планировщик отсекал ненужные месячные секции messages.
+    Returns: (messages, has_more, next_cursor)
+    '''
+    cursor_id = after_id if after_id is not None else before_id
+    cursor_at = None
+    if cursor_id:
+        cur.execute(f"SELECT created_at FROM {schema}.messages WHERE id = %s AND chat_id = %s", (cursor_id, chat_id))
+        row = cur.fetchone()
+        if row is None:
+            return [], False, None
+        cursor_at = row['created_at']
+    
+    if after_id == 0:
+        cursor_filter = ''
+        order = 'ASC'
+        query_params = (chat_id, limit + 1)
+    elif after_id is not None:
+        cursor_filter = "AND m.created_at >= %s AND (m.created_at, m.id) > (%s, %s)"
+        order = 'ASC'
+        query_params = (chat_id, cursor_at, cursor_at, after_id, limit + 1)
+    elif before_id is not None:
+        cursor_filter = "AND m.created_at <= %s AND (m.created_at, m.id) < (%s, %s)"
+        order = 'DESC'
+        query_params = (chat_id, cursor_at, cursor_at, before_id, limit + 1)
+    else:
+        cursor_filter = ''
+        order = 'DESC'
+        query_params = (chat_id, limit + 1)
+    
+    cur.execute(f"""
+        SELECT m.id, m.chat_id, m.sender_id, m.content, m.created_at,
+               COALESCE(m.is_ai, false) as is_ai,
+               m.attachment_url, m.attachment_type, m.attachment_name, m.attachment_size,
+               ap.thumbnails as attachment_thumbnails, ap.placeholder as attachment_placeholder
+        FROM {schema}.messages m
+        LEFT JOIN {schema}.attachment_previews ap ON ap.attachment_url = m.attachment_url
+        WHERE m.chat_id = %s {cursor_filter}
+        ORDER BY m.created_at {order}, m.id {order}
+        LIMIT %s
+    """, query_params)
+    messages = [dict(row) for row in cur.fetchall()]
     
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if order == 'DESC':
+        messages.reverse()
+    
+    add_sender_profiles(cur, schema, messages)
+    
+    next_cursor = None
+    if has_more:
+        next_cursor = messages[-1]['id'] if after_id is not None else messages[0]['id']
+    return messages, has_more, next_cursor
+
+CONTACT_IS_ONLINE_SQL = """CASE
+                               WHEN p.user_id IS NOT NULL
+                               THEN p.is_online AND p.last_heartbeat > NOW() - INTERVAL '5 minutes'
+                               WHEN u.last_seen IS NOT NULL
+                                    AND u.last_seen > NOW() - INTERVAL '5 minutes'
+                               THEN true
+                               ELSE COALESCE(u.is_online, false)
+                           END"""
+
+# Строка списка чатов для GET chats и sync; у групп из create_group имя хранится в groups
+CHAT_LIST_COLUMNS = """c.id, COALESCE(c.name, g.name) as name, (COALESCE(c.is_group, false) OR c.type = 'group') as is_group,
+                       COALESCE(s.last_message_content, '') as last_message,
+                       COALESCE(TO_CHAR(s.last_message_at, 'HH24:MI'), '') as time,
+                       GREATEST(COALESCE(s.message_count, 0) - cm.last_read_count, 0) as unread"""
+
+def encode_sync_token(since: int, since_time: datetime, until: Optional[int] = None,
+                      until_time: Optional[datetime] = None, after: Optional[List[int]] = None) -> str:
+    token: Dict[str, Any] = {'x': since, 't': since_time.isoformat()}
+    if until is not None:
+        token.update({'u': until, 'ut': until_time.isoformat(), 'a': after})
+    return encode_cursor(token)
+
+def decode_sync_token(value: Optional[str]) -> Optional[Dict[str, Any]]:
+    token = decode_cursor(value)
+    if token is None:
+        return None
     try:
-        if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
-            
-            if action == 'register':
-                phone = body_data.get('phone')
-                name = body_data.get('name', 'Пользователь')
-                avatar = body_data.get('avatar', 'П')
-                
+        decoded = {'since': int(token['x']), 'since_time': datetime.fromisoformat(token['t']),
+                   'until': None, 'until_time': None, 'after': None}
+        if token.get('u') is not None:
+            decoded.update({'until': int(token['u']), 'until_time': datetime.fromisoformat(token['ut']),
+                            'after': [int(token['a'][0]), int(token['a'][1])]})
+        return decoded
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        raise ValueError('Invalid sync token')
+
+def collect_sync_changes(cur, schema: str, user_id: Any, token: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Изменения с момента токена: чаты (сводка и своё членство), участники чатов, новые сообщения, контакты и их присутствие.
+    Диапазон — [since, until) по xid8 изменивших транзакций; until = xmin текущего снимка, т.е. всё ниже уже закоммичено.
+    Сообщения отдаются страницами по SYNC_MESSAGES_LIMIT; на страницах-продолжениях остальное не повторяется.
+    Присутствие пишется вне транзакций с change_xid, поэтому для него используется время прошлой синхронизации.
+    '''
+    since = token['since']
+    until, until_time = token['until'], token['until_time']
+    if until is None:
+        cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint as xmin, LOCALTIMESTAMP as server_time")
+        row = cur.fetchone()
+        until, until_time = row['xmin'], row['server_time']
+    xid_range = (str(since), str(until))
+    
+    # Членство читается в том же снимке, без кэша: чат, созданный другим экземпляром функции,
+    # иначе выпал бы из диапазона, и его сообщения потерялись бы за сдвинутым токеном
+    changes: Dict[str, Any] = {}
+    if token['after'] is None:
+        cur.execute(f"""
+            SELECT {CHAT_LIST_COLUMNS}
+            FROM {schema}.chat_memberships cm
+            JOIN {schema}.chats c ON c.id = cm.chat_id
+            LEFT JOIN {schema}.groups g ON g.id = c.group_id
+            LEFT JOIN {schema}.chat_summaries s ON s.chat_id = cm.chat_id
+            WHERE cm.user_id = %s
+              AND ((cm.change_xid >= %s::text::xid8 AND cm.change_xid < %s::text::xid8)
+                   OR (s.change_xid >= %s::text::xid8 AND s.change_xid < %s::text::xid8))
+            ORDER BY s.last_message_at DESC NULLS LAST
+        """, (user_id,) + xid_range + xid_range)
+        changes['chats'] = [dict(row) for row in cur.fetchall()]
+        
+        cur.execute(f"""
+            SELECT chat_id, user_id, last_read_message_id
+            FROM {schema}.chat_memberships
+            WHERE chat_id IN (SELECT chat_id FROM {schema}.chat_memberships WHERE user_id = %s) AND user_id <> %s
+              AND change_xid >= %s::text::xid8 AND change_xid < %s::text::xid8
+        """, (user_id, user_id) + xid_range)
+        changes['members'] = [dict(row) for row in cur.fetchall()]
+        
+        cur.execute(f"""
+            SELECT u.id, u.name, u.phone, u.avatar, {CONTACT_IS_ONLINE_SQL} as is_online
+            FROM {schema}.contacts c
+            JOIN {schema}.users u ON u.id = c.contact_user_id
+            LEFT JOIN {schema}.user_presence p ON p.user_id = u.id
+            WHERE c.user_id = %s
+              AND ((u.change_xid >= %s::text::xid8 AND u.change_xid < %s::text::xid8)
+                   OR (c.change_xid >= %s::text::xid8 AND c.change_xid < %s::text::xid8)
+                   OR p.last_heartbeat > %s - INTERVAL '5 minutes')
+            ORDER BY COALESCE(u.name, ''), u.id
+        """, (user_id,) + xid_range + xid_range + (token['since_time'],))
+        changes['contacts'] = [dict(row) for row in cur.fetchall()]
+    
+    cursor_filter = ''
+    query_params: List[Any] = [user_id, *xid_range]
+    if token['after'] is not None:
+        cursor_filter = 'AND (m.change_xid, m.id) > (%s::text::xid8, %s)'
+        query_params += [str(token['after'][0]), token['after'][1]]
+    query_params.append(SYNC_MESSAGES_LIMIT + 1)
+    cur.execute(f"""
+        SELECT m.id, m.chat_id, m.sender_id, m.content, m.created_at,
+               COALESCE(m.is_ai, false) as is_ai,
+               m.attachment_url, m.attachment_type, m.attachment_name, m.attachment_size,
+               ap.thumbnails as attachment_thumbnails, ap.placeholder as attachment_placeholder,
+               m.change_xid::text::bigint as change_xid
+        FROM {schema}.messages m
+        LEFT JOIN {schema}.attachment_previews ap ON ap.attachment_url = m.attachment_url
+        WHERE m.chat_id IN (SELECT chat_id FROM {schema}.chat_memberships WHERE user_id = %s)
+          AND m.change_xid >= %s::text::xid8 AND m.change_xid < %s::text::xid8 {cursor_filter}
+        ORDER BY m.change_xid, m.id
+        LIMIT %s
+    """, query_params)
+    messages = [dict(row) for row in cur.fetchall()]
+    has_more = len(messages) > SYNC_MESSAGES_LIMIT
+    messages = messages[:SYNC_MESSAGES_LIMIT]
+    add_sender_profiles(cur, schema, messages)
+    
+    if has_more:
+        next_token = encode_sync_token(since, token['since_time'], until, until_time,
+                                       [messages[-1]['change_xid'], messages[-1]['id']])
+    else:
+        next_token = encode_sync_token(until, until_time)
+    for msg in messages:
+        del msg['change_xid']
+    
+    changes.update({'messages': messages, 'has_more': has_more, 'sync_token': next_token})
+    return changes
+
+def wait_for_messages(conn, schema: str, chat_id: int, after_id: int, timeout: float) -> tuple:
+    '''
+    Long-poll: ждёт NOTIFY по каналу чата, пока не появятся сообщения после after_id или не истечёт timeout.
+    LISTEN выполняется до первой выборки, чтобы не пропустить сообщение, пришедшее между ними.
+    Курсор не из этого чата — LookupError (after_id = 0 допустим: ждём первое сообщение).
+    Если снять подписку не удалось, соединение закрывается, чтобы пул не выдал его с активным LISTEN.
+    '''
+    deadline = time.monotonic() + timeout
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        if after_id:
+            cur.execute(f"SELECT 1 FROM {schema}.messages WHERE id = %s AND chat_id = %s", (after_id, chat_id))
+            found = cur.fetchone() is not None
+            conn.rollback()
+            if not found:
+                raise LookupError('Unknown cursor')
+        cur.execute(f"LISTEN chat_{int(chat_id)}")
+        conn.commit()
+        try:
+            while True:
+                messages, has_more, _ = fetch_messages_page(cur, schema, chat_id, None, after_id, MESSAGES_PAGE_SIZE_MAX)
+                conn.rollback()
+                remaining = deadline - time.monotonic()
+                if messages or remaining <= 0:
+                    return messages, has_more
+                if select.select([conn], [], [], remaining) == ([], [], []):
+                    return [], False
+                conn.poll()
+                del conn.notifies[:]
+        finally:
+            try:
+                conn.rollback()
+                cur.execute("UNLISTEN *")
+                conn.commit()
+            except psycopg2.Error:
+                conn.close()
+
+_partitions_checked_at = 0.0
+
+def ensure_messages_partitions(conn, schema: str, force: bool = False) -> int:
+    '''
+    Заранее создаёт месячные секции messages; в тёплом процессе проверка идёт не чаще PARTITION_CHECK_INTERVAL.
+    '''
+    global _partitions_checked_at
+    now = time.monotonic()
+    if not force and now - _partitions_checked_at < PARTITION_CHECK_INTERVAL:
+        return 0
+    _partitions_checked_at = now
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {schema}.ensure_messages_partitions(%s)", (PARTITION_MONTHS_AHEAD,))
+        created = cur.fetchone()[0]
+    conn.commit()
+    return created
+
+def archive_messages_partitions(conn, schema: str, keep_months: int) -> List[Dict[str, Any]]:
+    '''
+    Выгружает месячные секции старше keep_months в gzip-CSV в MESSAGES_ARCHIVE_DIR,
+    затем отсоединяет и удаляет их. Секция блокируется от записи на время выгрузки,
+    а файл пишется до DETACH, чтобы данные не терялись при сбое.
+    URL вложений секции сохраняются в archived_attachments, чтобы сборщик мусора upload их не удалял.
+    '''
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE p.relname = 'messages' AND n.nspname = %s AND c.relname ~ '^messages_y[0-9]{4}m[0-9]{2}$'
+            ORDER BY c.relname
+        """, (schema,))
+        partitions = [row[0] for row in cur.fetchall()]
+    conn.rollback()
+    
+    today = datetime.now()
+    months = today.year * 12 + today.month - 1 - keep_months
+    cutoff_name = f"messages_y{months // 12:04d}m{months % 12 + 1:02d}"
+    
+    os.makedirs(MESSAGES_ARCHIVE_DIR, exist_ok=True)
+    archived = []
+    for partition in partitions:
+        if partition >= cutoff_name:
+            break
+        archive_path = os.path.join(MESSAGES_ARCHIVE_DIR, f"{partition}.csv.gz")
+        with conn.cursor() as cur:
+            cur.execute(f"LOCK TABLE {schema}.{partition} IN SHARE MODE")
+            with gzip.open(archive_path, 'wb') as f:
+                cur.copy_expert(f"COPY {schema}.{partition} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            cur.execute(f"SELECT COUNT(*) FROM {schema}.{partition}")
+            rows = cur.fetchone()[0]
+            cur.execute(f"""
+                INSERT INTO {schema}.archived_attachments (attachment_url, partition_name)
+                SELECT DISTINCT attachment_url, %s FROM {schema}.{partition} WHERE attachment_url IS NOT NULL
+                ON CONFLICT (attachment_url) DO NOTHING
+            """, (partition,))
+            cur.execute(f"ALTER TABLE {schema}.messages DETACH PARTITION {schema}.{partition}")
+            cur.execute(f"DROP TABLE {schema}.{partition}")
+        conn.commit()
+        archived.append({'partition': partition, 'rows': rows, 'file': archive_path, 'bytes': os.path.getsize(archive_path)})
+    return archived
+
+def unique_ids(ids: List[Any]) -> List[Any]:
+    return list(dict.fromkeys(i for i in ids if i is not None))
+
+def upsert_chat_summary(cur, schema: str, chat_id: int, message_id: int, content: str, created_at: datetime, added: int) -> int:
+    '''
+    Прибавляет added к счётчику сообщений чата; последнее сообщение заменяется, только если оно не старше текущего.
+    '''
+    cur.execute(f"""
+        INSERT INTO {schema}.chat_summaries (chat_id, last_message_id, last_message_content, last_message_at, message_count)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            last_message_id = CASE WHEN chat_summaries.last_message_at IS NULL OR EXCLUDED.last_message_at >= chat_summaries.last_message_at
+                                   THEN EXCLUDED.last_message_id ELSE chat_summaries.last_message_id END,
+            last_message_content = CASE WHEN chat_summaries.last_message_at IS NULL OR EXCLUDED.last_message_at >= chat_summaries.last_message_at
+                                        THEN EXCLUDED.last_message_content ELSE chat_summaries.last_message_content END,
+            last_message_at = GREATEST(chat_summaries.last_message_at, EXCLUDED.last_message_at),
+            message_count = chat_summaries.message_count + EXCLUDED.message_count,
+            change_xid = pg_current_xact_id()
+        RETURNING message_count
+    """, (chat_id, message_id, content, created_at, added))
+    return cur.fetchone()['message_count']
+
+def record_chat_message(cur, schema: str, message: Dict[str, Any]) -> None:
+    '''
+    Обновляет сводку чата (последнее сообщение, счётчик) в той же транзакции, что и вставка сообщения,
+    и шлёт NOTIFY в канал чата — он доставляется слушателям после COMMIT.
+    Отправитель сразу считается прочитавшим своё сообщение.
+    '''
+    message_count = upsert_chat_summary(cur, schema, message['chat_id'], message['id'], message['content'], message['created_at'], 1)
+    cur.execute("SELECT pg_notify(%s, %s)", (f"chat_{int(message['chat_id'])}", str(message['id'])))
+    
+    if message.get('sender_id') is not None:
+        for table in MEMBERSHIP_TABLES:
+            cur.execute(
+                f"UPDATE {schema}.{table} SET last_read_message_id = %s, last_read_count = %s, change_xid = pg_current_xact_id() WHERE chat_id = %s AND user_id = %s",
+                (message['id'], message_count, message['chat_id'], message['sender_id'])
+            )
+
+def mark_chat_read(cur, schema: str, chat_id: Any, user_id: Any, last_seen_id: Optional[int] = None) -> None:
+    '''
+    Сдвигает позицию прочтения участника на последнее сообщение чата по сводке.
+    С last_seen_id — только если это сообщение и есть последнее: клиент его уже получил,
+    а пришедшее позже останется непрочитанным. Позиция только растёт.
+    '''
+    for table in MEMBERSHIP_TABLES:
+        cur.execute(f"""
+            UPDATE {schema}.{table} cm
+            SET last_read_message_id = s.last_message_id, last_read_count = s.message_count,
+                change_xid = pg_current_xact_id()
+            FROM {schema}.chat_summaries s
+            WHERE s.chat_id = cm.chat_id AND cm.chat_id = %s AND cm.user_id = %s
+              AND cm.last_read_count < s.message_count
+              AND (%s::bigint IS NULL OR s.last_message_id = %s)
+        """, (chat_id, user_id, last_seen_id, last_seen_id))
+
+def parse_import_rows(data: str, data_format: str):
+    '''
+    Построчно разбирает NDJSON или CSV (с заголовком) и отдаёт словари записей с номером строки.
+    '''
+    stream = io.StringIO(data)
+    if data_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield record, reader.line_num
+        return
+    for line_no, line in enumerate(stream, 1):
+        if line.strip():
+            try:
+                yield json.loads(line), line_no
+            except json.JSONDecodeError:
+                raise ValueError(f'Line {line_no}: invalid JSON')
+
+def normalize_import_row(record: Dict[str, Any], chat_id: int, members: set, line_no: int) -> tuple:
+    where = f'Line {line_no}'
+    if not isinstance(record, dict):
+        raise ValueError(f'{where}: expected an object')
+    content = record.get('content')
+    if not isinstance(content, str) or not content:
+        raise ValueError(f'{where}: content is required')
+    sender_id = record.get('sender_id')
+    if sender_id in (None, ''):
+        sender_id = None
+    else:
+        try:
+            sender_id = int(sender_id)
+        except (TypeError, ValueError):
+            raise ValueError(f'{where}: invalid sender_id')
+        if sender_id not in members:
+            raise ValueError(f'{where}: sender {sender_id} is not a chat member')
+    try:
+        created_at = datetime.fromisoformat(str(record.get('created_at') or ''))
+    except ValueError:
+        raise ValueError(f'{where}: created_at must be an ISO 8601 timestamp')
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+    if created_at > datetime.now(timezone.utc).replace(tzinfo=None) + IMPORT_FUTURE_TOLERANCE:
+        raise ValueError(f'{where}: created_at is in the future')
+    is_ai = record.get('is_ai')
+    if isinstance(is_ai, str):
+        is_ai = is_ai.strip().lower() in ('1', 't', 'true', 'yes')
+    attachment_size = record.get('attachment_size')
+    try:
+        attachment_size = int(attachment_size) if attachment_size not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError(f'{where}: invalid attachment_size')
+    return (chat_id, sender_id, content, bool(is_ai), created_at,
+            record.get('attachment_url') or None, record.get('attachment_type') or None,
+            record.get('attachment_name') or None, attachment_size)
+
+def copy_import_chunk(cur, schema: str, rows: List[tuple]) -> None:
+    buffer = io.StringIO()
+    # Всё в кавычках, чтобы строка "\." в тексте не завершала COPY; пустые значения превращаются в NULL через FORCE_NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    for row in rows:
+        writer.writerow(['t' if value is True else 'f' if value is False else
+                         value.isoformat() if isinstance(value, datetime) else value for value in row])
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {schema}.messages ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv, FORCE_NULL ({', '.join(IMPORT_NULLABLE_COLUMNS)}))", buffer)
+
+def import_messages(conn, schema: str, chat_id: int, user_id: int, data: str, data_format: str, mark_read: bool) -> Dict[str, Any]:
+    '''
+    Массовый импорт истории чата через COPY с сохранением исходных created_at.
+    Членство проверяется один раз по chat_memberships в обход кэша, строки грузятся пачками по IMPORT_CHUNK_ROWS
+    в одной транзакции, сводка чата обновляется один раз в конце. При mark_read импортированная история считается прочитанной.
+    '''
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT user_id FROM {schema}.chat_memberships WHERE chat_id = %s", (chat_id,))
+        members = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    if int(user_id) not in members:
+        raise PermissionError('Not a chat member')
+    
+    rows: List[tuple] = []
+    for record, line_no in parse_import_rows(data, data_format):
+        if len(rows) >= IMPORT_MAX_ROWS:
+            raise ValueError(f'At most {IMPORT_MAX_ROWS} messages per import')
+        rows.append(normalize_import_row(record, chat_id, members, line_no))
+    if not rows:
+        return {'imported': 0, 'chat_id': chat_id}
+    
+    first_at = min(row[4] for row in rows)
+    last_at = max(row[4] for row in rows)
+    
+    # Секции создаются отдельной транзакцией: CREATE TABLE ... PARTITION OF блокирует messages целиком
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT {schema}.ensure_messages_partitions(%s, %s)", (PARTITION_MONTHS_AHEAD, first_at.date()))
+    conn.commit()
+    
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        for start in range(0, len(rows), IMPORT_CHUNK_ROWS):
+            copy_import_chunk(cur, schema, rows[start:start + IMPORT_CHUNK_ROWS])
+        
+        cur.execute(f"""
+            SELECT id, content, created_at FROM {schema}.messages
+            WHERE chat_id = %s AND created_at = %s
+            ORDER BY id DESC LIMIT 1
+        """, (chat_id, last_at))
+        last = cur.fetchone()
+        upsert_chat_summary(cur, schema, chat_id, last['id'], last['content'], last['created_at'], len(rows))
+        if mark_read:
+            for table in MEMBERSHIP_TABLES:
+                cur.execute(
+                    f"UPDATE {schema}.{table} SET last_read_count = last_read_count + %s, change_xid = pg_current_xact_id() WHERE chat_id = %s",
+                    (len(rows), chat_id)
+                )
+        conn.commit()
+    
+    return {
+        'imported': len(rows),
+        'chat_id': chat_id,
+        'first_created_at': first_at.isoformat(),
+        'last_created_at': last_at.isoformat()
+    }
+
+def estimate_tokens(text: str) -> int:
+    '''
+    Грубая локальная оценка числа токенов: ~4 байта UTF-8 на токен (кириллица дороже латиницы).
+    '''
+    return len(text.encode('utf-8')) // 4 + 1
+
+def fit_ai_context(history: List[Dict[str, Any]], token_budget: int) -> List[Dict[str, str]]:
+    '''
+    Оставляет самые свежие сообщения истории (от старых к новым), укладывающиеся в бюджет токенов.
+    Последнее сообщение попадает всегда, при необходимости обрезанное.
+    '''
+    context: List[Dict[str, str]] = []
+    budget = token_budget - estimate_tokens(AI_SYSTEM_PROMPT)
+    for item in reversed(history):
+        content = item['content'] or ''
+        tokens = estimate_tokens(content)
+        if tokens > budget:
+            if not context:
+                context.append({'role': 'assistant' if item.get('is_ai') else 'user', 'content': content[:max(budget, 1) * 2]})
+            break
+        context.append({'role': 'assistant' if item.get('is_ai') else 'user', 'content': content})
+        budget -= tokens
+    context.reverse()
+    return context
+
+def build_ai_context(cur, schema: str, chat_id: int, up_to_message_id: int) -> List[Dict[str, str]]:
+    cur.execute(f"""
+        SELECT content, COALESCE(is_ai, false) as is_ai
+        FROM {schema}.messages
+        WHERE chat_id = %s AND (created_at, id) <= (SELECT created_at, id FROM {schema}.messages WHERE id = %s)
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """, (chat_id, up_to_message_id, AI_CONTEXT_MESSAGES))
+    history = [dict(row) for row in cur.fetchall()]
+    history.reverse()
+    return fit_ai_context(history, AI_CONTEXT_TOKEN_BUDGET)
+
+def ai_cache_key(context: List[Dict[str, str]]) -> str:
+    normalized = [(item['role'], re.sub(r'\s+', ' ', item['content']).strip().lower()) for item in context]
+    return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def request_ai_completion(context: List[Dict[str, str]]) -> str:
+    cache_key = ai_cache_key(context)
+    cached = ai_response_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    openai_data = {
+        'model': 'gpt-3.5-turbo',
+        'messages': [{'role': 'system', 'content': AI_SYSTEM_PROMPT}] + context,
+        'max_tokens': 500,
+        'temperature': 0.7
+    }
+    
+    request_data = json.dumps(openai_data).encode('utf-8')
+    req = urllib.request.Request(
+        OPENAI_API_URL,
+        data=request_data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {OPENAI_API_KEY}'
+        }
+    )
+    
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        with urllib.request.urlopen(req, timeout=AI_REQUEST_TIMEOUT) as response:
+            result = json.loads(response.read().decode('utf-8'))
+            reply_text = result['choices'][0]['message']['content']
+        outcome = 'ok'
+    finally:
+        metrics.observe('chattix_ai_request_duration_seconds', time.perf_counter() - started, outcome=outcome)
+    
+    ai_response_cache.set(cache_key, reply_text)
+    return reply_text
+
+def claim_ai_jobs(conn, schema: str, limit: int, chat_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    '''
+    Забирает в работу самые старые незавершённые задания — не больше одного на чат,
+    чтобы ответы в чате приходили в порядке вопросов. Просроченная аренда снимается повторно.
+    С chat_id — только задание этого чата.
+    '''
+    chat_filter = 'AND chat_id = %s' if chat_id is not None else ''
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(f"""
+            WITH heads AS (
+                SELECT DISTINCT ON (chat_id) id, status, locked_until, run_after
+                FROM {schema}.ai_jobs
+                WHERE status IN ('pending', 'running') {chat_filter}
+                ORDER BY chat_id, id
+            ), ready AS (
+                SELECT id FROM heads
+                WHERE run_after <= NOW() AND (status = 'pending' OR locked_until < NOW())
+                ORDER BY id
+                LIMIT %s
+            )
+            UPDATE {schema}.ai_jobs j
+            SET status = 'running', attempts = j.attempts + 1,
+                locked_until = NOW() + make_interval(secs => %s), updated_at = NOW()
+            FROM ready
+            WHERE j.id = ready.id AND (j.status = 'pending' OR j.locked_until < NOW())
+            RETURNING j.id, j.chat_id, j.message_id, j.prompt, j.attempts
+        """, ([chat_id] if chat_id is not None else []) + [limit, AI_JOB_LEASE_SECONDS])
+        jobs = [dict(row) for row in cur.fetchall()]
+    conn.commit()
+    return jobs
+
+def complete_ai_job(conn, schema: str, job: Dict[str, Any], reply_text: Optional[str], error: Optional[str]) -> None:
+    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+        if reply_text is None and job['attempts'] < AI_JOB_MAX_ATTEMPTS:
+            cur.execute(f"""
+                UPDATE {schema}.ai_jobs
+                SET status = 'pending', locked_until = NULL, last_error = %s, updated_at = NOW(),
+                    run_after = NOW() + make_interval(secs => %s)
+                WHERE id = %s AND status = 'running' AND attempts = %s
+            """, (error, 2 ** job['attempts'], job['id'], job['attempts']))
+            conn.commit()
+            return
+        
+        cur.execute(f"""
+            UPDATE {schema}.ai_jobs
+            SET status = %s, locked_until = NULL, last_error = %s, updated_at = NOW()
+            WHERE id = %s AND status = 'running' AND attempts = %s
+            RETURNING id
+        """, ('done' if reply_text is not None else 'failed', error, job['id'], job['attempts']))
+        if cur.fetchone() is None:
+            conn.rollback()
+            return
+        
+        cur.execute(
+            f"INSERT INTO {schema}.messages (chat_id, sender_id, content, is_ai) VALUES (%s, %s, %s, %s) RETURNING id, chat_id, sender_id, content, created_at, is_ai",
+            (job['chat_id'], None, reply_text if reply_text is not None else AI_ERROR_REPLY, True)
+        )
+        reply = dict(cur.fetchone())
+        record_chat_message(cur, schema, reply)
+        cur.execute(f"UPDATE {schema}.ai_jobs SET reply_message_id = %s WHERE id = %s", (reply['id'], job['id']))
+        conn.commit()
+
+def run_ai_job(job: Dict[str, Any]) -> tuple:
+    try:
+        return request_ai_completion(job['context']), None
+    except Exception as e:
+        log_event('ai_job_failed', logging.WARNING, job_id=job['id'], chat_id=job['chat_id'],
+                  attempt=job['attempts'], error=f'{type(e).__name__}: {e}')
+        return None, f'{type(e).__name__}: {e}'
+
+def drain_ai_jobs(max_jobs: int = 100, chat_id: Optional[int] = None) -> Dict[str, int]:
+    '''
+    Обрабатывает очередь AI-заданий пачками по AI_WORKER_CONCURRENCY (с chat_id — только этого чата).
+    Соединение с базой не удерживается, пока идут запросы к AI.
+    '''
+    processed = {'done': 0, 'retried': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=AI_WORKER_CONCURRENCY) as executor:
+        while sum(processed.values()) < max_jobs:
+            conn, schema = get_db_connection()
+            try:
+                jobs = claim_ai_jobs(conn, schema, min(AI_WORKER_CONCURRENCY, max_jobs - sum(processed.values())), chat_id)
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(f"""
-                        INSERT INTO {schema}.users (phone, name, avatar, is_online, last_seen) 
-                        VALUES (%s, %s, %s, true, NOW()) 
-                        ON CONFLICT (phone) 
-                        DO UPDATE SET name = EXCLUDED.name, is_online = true, last_seen = NOW() 
-                        RETURNING id, phone, name, avatar
-                    """, (phone, name, avatar))
-                    conn.commit()
-                    user = dict(cur.fetchone())
-                
+                    for job in jobs:
+                        job['context'] = build_ai_context(cur, schema, job['chat_id'], job['message_id']) or [{'role': 'user', 'content': job['prompt']}]
+                conn.rollback()
+            finally:
+                release_db_connection(conn)
+            if not jobs:
+                break
+            
+            results = list(executor.map(run_ai_job, jobs))
+            
+            conn, schema = get_db_connection()
+            try:
+                for job, (reply_text, error) in zip(jobs, results):
+                    complete_ai_job(conn, schema, job, reply_text, error)
+                    if reply_text is not None:
+                        processed['done'] += 1
+                    elif job['attempts'] < AI_JOB_MAX_ATTEMPTS:
+                        processed['retried'] += 1
+                    else:
+                        processed['failed'] += 1
+            finally:
+                release_db_connection(conn)
+    return processed
+
+_ai_worker_lock = threading.Lock()
+
+def start_ai_worker() -> None:
+    '''
+    Запускает фоновый разбор очереди в тёплом процессе, если он ещё не запущен.
+    Среда может заморозить поток после ответа, поэтому это только ускорение: задания, не разобранные здесь,
+    добирает long-poll чата (GET ?path=poll), который клиент держит открытым, пока ждёт ответ.
+    '''
+    if not _ai_worker_lock.acquire(blocking=False):
+        return
+    
+    def worker():
+        try:
+            drain_ai_jobs()
+        except Exception:
+            logger.exception('AI worker failed')
+        finally:
+            _ai_worker_lock.release()
+    
+    threading.Thread(target=worker, daemon=True).start()
+
+def run_batch(conn, schema: str, requests: List[Dict[str, Any]], user_id: Optional[str]) -> List[Dict[str, Any]]:
+    '''
+    Выполняет несколько запросов API на одном соединении. Подряд идущие GET читают
+    из одного снимка (REPEATABLE READ, READ ONLY); POST выполняются в собственных транзакциях.
+    '''
+    results = []
+    snapshot_open = False
+    for item in requests:
+        if not isinstance(item, dict):
+            results.append({'statusCode': 400, 'body': {'error': 'Batch request must be an object'}})
+            continue
+        method = item.get('method') or 'GET'
+        params = item.get('params') or {}
+        body_data = item.get('body') or {}
+        if not isinstance(method, str) or not isinstance(params, dict) or not isinstance(body_data, dict):
+            results.append({'statusCode': 400, 'body': {'error': 'Batch request must have string method and object params and body'}})
+            continue
+        method = method.upper()
+        
+        if (method == 'GET' and params.get('path') in BATCH_EXCLUDED_PATHS) or \
+                (method == 'POST' and body_data.get('action') in BATCH_EXCLUDED_ACTIONS) or method not in ('GET', 'POST'):
+            results.append({'statusCode': 400, 'body': {'error': 'Request is not allowed in batch'}})
+            continue
+        
+        if method == 'GET' and not snapshot_open:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            snapshot_open = True
+        elif method == 'POST':
+            conn.rollback()
+            snapshot_open = False
+        
+        try:
+            response = route_request(conn, schema, method, params, body_data, user_id)
+            results.append({'statusCode': response['statusCode'], 'body': json.loads(response['body'])})
+        except Exception as e:
+            conn.rollback()
+            snapshot_open = False
+            results.append({'statusCode': 500, 'body': {'error': str(e)}})
+    
+    conn.rollback()
+    return results
+
+@instrumented_route
+def route_request(conn, schema: str, method: str, params: Dict[str, Any], body_data: Dict[str, Any], user_id: Optional[str]) -> Dict[str, Any]:
+    path = params.get('path', '')
+    
+    if method == 'POST':
+        action = body_data.get('action')
+        
+        if action == 'register':
+            phone = body_data.get('phone')
+            name = body_data.get('name', 'Пользователь')
+            avatar = body_data.get('avatar', 'П')
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    INSERT INTO {schema}.users (phone, name, avatar, is_online, last_seen) 
+                    VALUES (%s, %s, %s, true, NOW()) 
+                    ON CONFLICT (phone) 
+                    DO UPDATE SET name = EXCLUDED.name, is_online = true, last_seen = NOW(),
+                                  updated_at = CASE WHEN users.name IS DISTINCT FROM EXCLUDED.name THEN NOW() ELSE users.updated_at END,
+                                  change_xid = pg_current_xact_id()
+                    RETURNING id, phone, name, avatar
+                """, (phone, name, avatar))
+                conn.commit()
+                user = dict(cur.fetchone())
+            invalidate_users([user['id']], [user['phone']])
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'user': user}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'send_message':
+            chat_id = body_data.get('chat_id')
+            sender_id = body_data.get('sender_id')
+            content = body_data.get('content')
+            is_ai = body_data.get('is_ai', False)
+            should_reply = body_data.get('should_reply', False)
+            attachment = body_data.get('attachment') or {}
+            if chat_id is None or sender_id is None or not isinstance(content, str):
                 return {
-                    'statusCode': 200,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'user': user}),
+                    'body': json.dumps({'error': 'chat_id, sender_id and content are required'}),
                     'isBase64Encoded': False
                 }
             
-            elif action == 'send_message':
-                chat_id = body_data.get('chat_id')
-                sender_id = body_data.get('sender_id')
-                content = body_data.get('content')
-                is_ai = body_data.get('is_ai', False)
-                should_reply = body_data.get('should_reply', False)
+            try:
+                ensure_messages_partitions(conn, schema)
+            except psycopg2.Error:
+                conn.rollback()
+                logger.exception('Messages partition maintenance failed')
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"""INSERT INTO {schema}.messages (chat_id, sender_id, content, is_ai, attachment_url, attachment_type, attachment_name, attachment_size)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        RETURNING id, chat_id, sender_id, content, created_at, is_ai, attachment_url, attachment_type, attachment_name, attachment_size""",
+                    (chat_id, sender_id, content, is_ai, attachment.get('url'), attachment.get('type'), attachment.get('name'), attachment.get('size'))
+                )
+                message = dict(cur.fetchone())
+                record_chat_message(cur, schema, message)
                 
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                ai_job_id = None
+                if should_reply and not is_ai and OPENAI_API_KEY:
                     cur.execute(
-                        f"INSERT INTO {schema}.messages (chat_id, sender_id, content, is_ai) VALUES (%s, %s, %s, %s) RETURNING id, chat_id, sender_id, content, created_at, is_ai",
-                        (chat_id, sender_id, content, is_ai)
+                        f"INSERT INTO {schema}.ai_jobs (chat_id, message_id, prompt) VALUES (%s, %s, %s) RETURNING id",
+                        (chat_id, message['id'], content)
                     )
-                    conn.commit()
-                    message = dict(cur.fetchone())
-                    message['created_at'] = message['created_at'].isoformat()
+                    ai_job_id = cur.fetchone()['id']
                 
-                ai_reply = None
-                if should_reply and not is_ai and OPENAI_API_KEY:
-                    openai_data = {
-                        'model': 'gpt-3.5-turbo',
-                        'messages': [
-                            {'role': 'system', 'content': 'Ты - Chattik AI, дружелюбный помощник в мессенджере Chattik. Отвечай кратко, по-дружески и на русском языке.'},
-                            {'role': 'user', 'content': content}
-                        ],
-                        'max_tokens': 500,
-                        'temperature': 0.7
-                    }
-                    
-                    request_data = json.dumps(openai_data).encode('utf-8')
-                    req = urllib.request.Request(
-                        'https://api.openai.com/v1/chat/completions',
-                        data=request_data,
-                        headers={
-                            'Content-Type': 'application/json',
-                            'Authorization': f'Bearer {OPENAI_API_KEY}'
-                        }
-                    )
-                    
-                    try:
-                        with urllib.request.urlopen(req) as response:
-                            result = json.loads(response.read().decode('utf-8'))
-                            ai_response_text = result['choices'][0]['message']['content']
-                            
-                            cur.execute(
-                                f"INSERT INTO {schema}.messages (chat_id, sender_id, content, is_ai) VALUES (%s, %s, %s, %s) RETURNING id, chat_id, sender_id, content, created_at, is_ai",
-                                (chat_id, None, ai_response_text, True)
-                            )
-                            conn.commit()
-                            ai_reply = dict(cur.fetchone())
-                            ai_reply['created_at'] = ai_reply['created_at'].isoformat()
-                    except Exception:
-                        pass
+                conn.commit()
+                message['created_at'] = message['created_at'].isoformat()
+            
+            response_data = {'message': message}
+            if ai_job_id is not None:
+                response_data['ai_job_id'] = ai_job_id
+                start_ai_worker()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(response_data),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'create_chat':
+            name = body_data.get('name', '')
+            is_group = body_data.get('is_group', False)
+            members = body_data.get('members', [])
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    "INSERT INTO chats (name, is_group) VALUES (%s, %s) RETURNING id, name, is_group",
+                    (name, is_group)
+                )
+                chat = dict(cur.fetchone())
+                chat_id = chat['id']
                 
-                response_data = {'message': message}
-                if ai_reply:
-                    response_data['ai_reply'] = ai_reply
+                execute_values(
+                    cur,
+                    "INSERT INTO chat_members (chat_id, user_id) VALUES %s ON CONFLICT DO NOTHING",
+                    [(chat_id, member_id) for member_id in unique_ids(members)],
+                    page_size=MEMBERS_INSERT_PAGE_SIZE
+                )
                 
+                conn.commit()
+            invalidate_users(members)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'chat': chat}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'add_contact':
+            user_id_param = body_data.get('user_id')
+            contact_user_id = body_data.get('contact_user_id')
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(
+                    f"INSERT INTO {schema}.contacts (user_id, contact_user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+                    (user_id_param, contact_user_id)
+                )
+                conn.commit()
+            invalidate_users([user_id_param, contact_user_id])
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True}),
+                'isBase64Encoded': False
+            }
+        
+        elif action in ('update_online_status', 'update_status'):
+            try:
+                user_id_param = int(body_data.get('user_id'))
+            except (TypeError, ValueError):
                 return {
-                    'statusCode': 200,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps(response_data),
+                    'body': json.dumps({'error': 'user_id is required'}),
                     'isBase64Encoded': False
                 }
+            is_online = body_data.get('is_online', True)
             
-            elif action == 'create_chat':
-                name = body_data.get('name', '')
-                is_group = body_data.get('is_group', False)
-                members = body_data.get('members', [])
+            record_heartbeat(conn, schema, user_id_param, is_online)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'flush_presence':
+            flushed = flush_presence(conn, schema)
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'flushed': flushed, 'stats': presence_stats}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'mark_read':
+            chat_id = body_data.get('chat_id')
+            user_id_param = body_data.get('user_id')
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                mark_chat_read(cur, schema, chat_id, user_id_param)
+                conn.commit()
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': True}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'create_group':
+            name = body_data.get('name')
+            description = body_data.get('description', '')
+            avatar = body_data.get('avatar', '👥')
+            created_by = body_data.get('created_by')
+            member_ids = body_data.get('member_ids', [])
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"INSERT INTO {schema}.groups (name, description, avatar, created_by) VALUES (%s, %s, %s, %s) RETURNING id", (name, description, avatar, created_by))
+                group_id = cur.fetchone()['id']
                 
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        "INSERT INTO chats (name, is_group) VALUES (%s, %s) RETURNING id, name, is_group",
-                        (name, is_group)
-                    )
-                    chat = dict(cur.fetchone())
-                    chat_id = chat['id']
-                    
-                    for member_id in members:
-                        cur.execute(
-                            "INSERT INTO chat_members (chat_id, user_id) VALUES (%s, %s)",
-                            (chat_id, member_id)
-                        )
-                    
-                    conn.commit()
+                cur.execute(f"INSERT INTO {schema}.chats (type, group_id) VALUES ('group', %s) RETURNING id", (group_id,))
+                chat_id = cur.fetchone()['id']
+                
+                all_members = unique_ids([created_by] + member_ids)
+                execute_values(
+                    cur,
+                    f"INSERT INTO {schema}.group_members (group_id, user_id, role) VALUES %s ON CONFLICT DO NOTHING",
+                    [(group_id, member_id, 'admin' if member_id == created_by else 'member') for member_id in all_members],
+                    page_size=MEMBERS_INSERT_PAGE_SIZE
+                )
+                execute_values(
+                    cur,
+                    f"INSERT INTO {schema}.chat_participants (chat_id, user_id) VALUES %s ON CONFLICT DO NOTHING",
+                    [(chat_id, member_id) for member_id in all_members],
+                    page_size=MEMBERS_INSERT_PAGE_SIZE
+                )
                 
+                conn.commit()
+            invalidate_users(all_members)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'group_id': group_id, 'chat_id': chat_id}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'ai_response':
+            user_message = body_data.get('message', '')
+            
+            if not OPENAI_API_KEY:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'chat': chat}),
+                    'body': json.dumps({'response': 'AI временно недоступен. Добавьте OPENAI_API_KEY в настройки проекта.'}),
                     'isBase64Encoded': False
                 }
             
-            elif action == 'add_contact':
-                user_id_param = body_data.get('user_id')
-                contact_user_id = body_data.get('contact_user_id')
-                
+            chat_id = body_data.get('chat_id')
+            if chat_id:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        f"INSERT INTO {schema}.contacts (user_id, contact_user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-                        (user_id_param, contact_user_id)
-                    )
-                    conn.commit()
-                
+                    cur.execute(f"""
+                        SELECT content, COALESCE(is_ai, false) as is_ai
+                        FROM {schema}.messages
+                        WHERE chat_id = %s
+                        ORDER BY created_at DESC, id DESC
+                        LIMIT %s
+                    """, (chat_id, AI_CONTEXT_MESSAGES))
+                    history = [dict(row) for row in cur.fetchall()]
+                history.reverse()
+            else:
+                history = []
+            context = fit_ai_context(history + [{'content': user_message, 'is_ai': False}], AI_CONTEXT_TOKEN_BUDGET)
+            
+            try:
+                ai_response = request_ai_completion(context)
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
+                    'body': json.dumps({'response': ai_response}),
                     'isBase64Encoded': False
                 }
-            
-            elif action == 'update_online_status':
-                user_id_param = body_data.get('user_id')
-                is_online = body_data.get('is_online', True)
-                
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        f"UPDATE {schema}.users SET is_online = %s, last_seen = CURRENT_TIMESTAMP WHERE id = %s",
-                        (is_online, user_id_param)
-                    )
-                    conn.commit()
-                
+            except Exception:
+                logger.exception('AI response failed')
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
+                    'body': json.dumps({'response': AI_ERROR_REPLY}),
+                    'isBase64Encoded': False
+                }
+        
+        elif action == 'batch':
+            requests = body_data.get('requests') or []
+            if not isinstance(requests, list) or len(requests) > BATCH_MAX_REQUESTS:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': f'Batch must be a list of at most {BATCH_MAX_REQUESTS} requests'}),
                     'isBase64Encoded': False
                 }
             
-            elif action == 'update_status':
-                user_id_param = body_data.get('user_id')
-                is_online = body_data.get('is_online', True)
-                
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(
-                        f"UPDATE {schema}.users SET is_online = %s, last_seen = NOW() WHERE id = %s",
-                        (is_online, user_id_param)
-                    )
-                    conn.commit()
-                
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'results': run_batch(conn, schema, requests, user_id)}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'import_messages' and user_id:
+            data_format = body_data.get('format', 'ndjson')
+            try:
+                chat_id = int(body_data.get('chat_id'))
+                if data_format not in ('ndjson', 'csv'):
+                    raise ValueError('Format must be ndjson or csv')
+                result = import_messages(conn, schema, chat_id, int(user_id), body_data.get('data') or '',
+                                         data_format, body_data.get('mark_read', True))
+            except PermissionError as e:
                 return {
-                    'statusCode': 200,
+                    'statusCode': 403,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'success': True}),
+                    'body': json.dumps({'error': str(e)}),
+                    'isBase64Encoded': False
+                }
+            except (TypeError, ValueError) as e:
+                conn.rollback()
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': str(e)}),
                     'isBase64Encoded': False
                 }
             
-            elif action == 'create_group':
-                name = body_data.get('name')
-                description = body_data.get('description', '')
-                avatar = body_data.get('avatar', '👥')
-                created_by = body_data.get('created_by')
-                member_ids = body_data.get('member_ids', [])
-                
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(f"INSERT INTO {schema}.groups (name, description, avatar, created_by) VALUES (%s, %s, %s, %s) RETURNING id", (name, description, avatar, created_by))
-                    group_id = cur.fetchone()['id']
-                    
-                    cur.execute(f"INSERT INTO {schema}.chats (type, group_id) VALUES ('group', %s) RETURNING id", (group_id,))
-                    chat_id = cur.fetchone()['id']
-                    
-                    all_members = [created_by] + member_ids
-                    for member_id in all_members:
-                        cur.execute(f"INSERT INTO {schema}.group_members (group_id, user_id, role) VALUES (%s, %s, %s)", (group_id, member_id, 'admin' if member_id == created_by else 'member'))
-                        cur.execute(f"INSERT INTO {schema}.chat_participants (chat_id, user_id) VALUES (%s, %s)", (chat_id, member_id))
-                    
-                    conn.commit()
-                
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'maintain_partitions':
+            created = ensure_messages_partitions(conn, schema, force=True)
+            archived = []
+            if body_data.get('archive_older_than_months') is not None:
+                archived = archive_messages_partitions(conn, schema, int(body_data['archive_older_than_months']))
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'created': created, 'archived': archived}),
+                'isBase64Encoded': False
+            }
+        
+        elif action == 'process_ai_jobs':
+            processed = drain_ai_jobs(int(body_data.get('max_jobs', 100)))
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'processed': processed, 'cache': dict(ai_response_cache.stats, hit_rate=ai_response_cache.hit_rate())}),
+                'isBase64Encoded': False
+            }
+    
+    elif method == 'GET':
+        if path == 'chats' and user_id:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute(f"""
+                    SELECT {CHAT_LIST_COLUMNS}
+                    FROM {schema}.chat_memberships cm
+                    JOIN {schema}.chats c ON c.id = cm.chat_id
+                    LEFT JOIN {schema}.groups g ON g.id = c.group_id
+                    LEFT JOIN {schema}.chat_summaries s ON s.chat_id = cm.chat_id
+                    WHERE cm.user_id = %s
+                    ORDER BY s.last_message_at DESC NULLS LAST
+                """, (user_id,))
+                chats = [dict(row) for row in cur.fetchall()]
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'chats': chats}),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'contacts' and user_id:
+            try:
+                limit = parse_page_size(params.get('limit'), CONTACTS_PAGE_SIZE, CONTACTS_PAGE_SIZE_MAX)
+                after = decode_keyset_cursor(params.get('cursor'), str)
+                token = decode_sync_token(params.get('token'))
+            except ValueError:
                 return {
-                    'statusCode': 200,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'group_id': group_id, 'chat_id': chat_id}),
+                    'body': json.dumps({'error': 'Invalid pagination parameters'}),
                     'isBase64Encoded': False
                 }
             
-            elif action == 'ai_response':
-                user_message = body_data.get('message', '')
-                
-                if not OPENAI_API_KEY:
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'response': 'AI временно недоступен. Добавьте OPENAI_API_KEY в настройки проекта.'}),
-                        'isBase64Encoded': False
-                    }
-                
-                openai_data = {
-                    'model': 'gpt-3.5-turbo',
-                    'messages': [
-                        {'role': 'system', 'content': 'Ты - Chattik AI, дружелюбный помощник в мессенджере Chattik. Отвечай кратко, по-дружески и на русском языке.'},
-                        {'role': 'user', 'content': user_message}
-                    ],
-                    'max_tokens': 500,
-                    'temperature': 0.7
+            filters = ''
+            query_params: List[Any] = [user_id]
+            if after is not None:
+                filters += " AND (COALESCE(u.name, ''), u.id) > (%s, %s)"
+                query_params += [after[0], after[1]]
+            if token is not None:
+                filters += (" AND (u.change_xid >= %s::text::xid8 OR c.change_xid >= %s::text::xid8"
+                            " OR p.last_heartbeat > %s - INTERVAL '5 minutes')")
+                query_params += [str(token['since']), str(token['since']), token['since_time']]
+            query_params.append(limit + 1)
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                # Токен — xmin снимка, как у sync: всё с меньшим xid уже закоммичено и видно следующей выборке,
+                # а незавершённые транзакции попадут в выборку с этим токеном (повторы безвредны).
+                # Клиент берёт токен с первой страницы, поэтому на страницах-продолжениях его нет
+                sync_token = None
+                if after is None:
+                    cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint as xmin, LOCALTIMESTAMP as server_time")
+                    row = cur.fetchone()
+                    sync_token = encode_sync_token(row['xmin'], row['server_time'])
+                cur.execute(f"""
+                    SELECT u.id, u.name, u.phone, u.avatar, {CONTACT_IS_ONLINE_SQL} as is_online
+                    FROM {schema}.contacts c
+                    JOIN {schema}.users u ON u.id = c.contact_user_id
+                    LEFT JOIN {schema}.user_presence p ON p.user_id = u.id
+                    WHERE c.user_id = %s {filters}
+                    ORDER BY COALESCE(u.name, ''), u.id
+                    LIMIT %s
+                """, query_params)
+                contacts = [dict(row) for row in cur.fetchall()]
+            
+            next_cursor = None
+            if len(contacts) > limit:
+                contacts = contacts[:limit]
+                next_cursor = encode_cursor([contacts[-1]['name'] or '', contacts[-1]['id']])
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'contacts': contacts, 'next_cursor': next_cursor, 'sync_token': sync_token}),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'sync' and user_id:
+            try:
+                token = decode_sync_token(params.get('token'))
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid sync token'}),
+                    'isBase64Encoded': False
                 }
-                
-                request_data = json.dumps(openai_data).encode('utf-8')
-                req = urllib.request.Request(
-                    'https://api.openai.com/v1/chat/completions',
-                    data=request_data,
-                    headers={
-                        'Content-Type': 'application/json',
-                        'Authorization': f'Bearer {OPENAI_API_KEY}'
-                    }
-                )
-                
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                if token is None:
+                    # Первый запуск: клиент берёт токен до полной загрузки chats/contacts/messages;
+                    # изменения, попавшие между ними, придут повторно, и их применение идемпотентно
+                    cur.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint as xmin, LOCALTIMESTAMP as server_time")
+                    row = cur.fetchone()
+                    result = {'sync_token': encode_sync_token(row['xmin'], row['server_time']), 'full_resync': True}
+                else:
+                    result = collect_sync_changes(cur, schema, user_id, token)
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps(result),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'messages':
+            chat_id = params.get('chat_id')
+            try:
+                before_id = parse_int_param(params.get('before_id'))
+                after_id = parse_int_param(params.get('after_id'))
+                limit = parse_page_size(params.get('limit'), MESSAGES_PAGE_SIZE, MESSAGES_PAGE_SIZE_MAX)
+            except ValueError:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Invalid pagination parameters'}),
+                    'isBase64Encoded': False
+                }
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                messages, has_more, next_cursor = fetch_messages_page(cur, schema, chat_id, before_id, after_id, limit)
+                # Участник открыл свежую часть чата — всё до последнего полученного сообщения прочитано
+                if user_id and messages and before_id is None:
+                    mark_chat_read(cur, schema, chat_id, user_id, messages[-1]['id'])
+                conn.commit()
+
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'messages': messages, 'has_more': has_more, 'next_cursor': next_cursor}),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'poll':
+            try:
+                chat_id = parse_int_param(params.get('chat_id'))
+                after_id = parse_int_param(params.get('after_id'))
+                timeout = min(float(params.get('timeout') or LONG_POLL_TIMEOUT_MAX), LONG_POLL_TIMEOUT_MAX)
+            except ValueError:
+                chat_id = None
+            if chat_id is None or after_id is None:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'chat_id and after_id are required'}),
+                    'isBase64Encoded': False
+                }
+            
+            if OPENAI_API_KEY:
+                started = time.monotonic()
                 try:
-                    with urllib.request.urlopen(req) as response:
-                        result = json.loads(response.read().decode('utf-8'))
-                        ai_response = result['choices'][0]['message']['content']
-                        
-                        return {
-                            'statusCode': 200,
-                            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                            'body': json.dumps({'response': ai_response}),
-                            'isBase64Encoded': False
-                        }
+                    drain_ai_jobs(AI_POLL_DRAIN_MAX_JOBS, chat_id)
                 except Exception:
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'response': 'Извините, произошла ошибка. Попробуйте позже.'}),
-                        'isBase64Encoded': False
-                    }
-        
-        elif method == 'GET':
-            if path == 'chats' and user_id:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute("""
-                        SELECT c.id, c.name, c.is_group,
-                               COALESCE(last_msg.content, '') as last_message,
-                               COALESCE(TO_CHAR(last_msg.created_at, 'HH24:MI'), '') as time,
-                               0 as unread
-                        FROM chats c
-                        JOIN chat_members cm ON cm.chat_id = c.id
-                        LEFT JOIN LATERAL (
-                            SELECT content, created_at
-                            FROM messages
-                            WHERE chat_id = c.id
-                            ORDER BY created_at DESC
-                            LIMIT 1
-                        ) last_msg ON true
-                        WHERE cm.user_id = %s
-                        ORDER BY last_msg.created_at DESC NULLS LAST
-                    """, (user_id,))
-                    chats = [dict(row) for row in cur.fetchall()]
-                
+                    logger.exception('AI jobs drain in poll failed')
+                timeout = max(timeout - (time.monotonic() - started), 0.0)
+            
+            try:
+                messages, has_more = wait_for_messages(conn, schema, chat_id, after_id, timeout)
+            except LookupError:
                 return {
-                    'statusCode': 200,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'chats': chats}),
+                    'body': json.dumps({'error': 'after_id is not a message of this chat'}),
                     'isBase64Encoded': False
                 }
-            
-            elif path == 'contacts' and user_id:
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(f"""
-                        SELECT id, name, phone, avatar, 
-                               COALESCE(is_online, false) as is_online,
-                               CASE 
-                                   WHEN last_seen IS NOT NULL 
-                                        AND last_seen > NOW() - INTERVAL '5 minutes' 
-                                   THEN true 
-                                   ELSE COALESCE(is_online, false)
-                               END as is_online_realtime
-                        FROM {schema}.users
-                        WHERE id != %s
-                        ORDER BY name
-                    """, (user_id,))
-                    contacts = [dict(row) for row in cur.fetchall()]
-                    
-                    for contact in contacts:
-                        contact['is_online'] = contact.get('is_online_realtime', False)
-                        if 'is_online_realtime' in contact:
-                            del contact['is_online_realtime']
-                
+
+            if user_id and messages and not has_more:
+                with conn.cursor() as cur:
+                    mark_chat_read(cur, schema, chat_id, user_id, messages[-1]['id'])
+                conn.commit()
+
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'messages': messages,
+                    'has_more': has_more,
+                    'cursor': messages[-1]['id'] if messages else after_id
+                }),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'search_messages' and user_id:
+            query_text = (params.get('q') or '').strip()
+            try:
+                limit = parse_page_size(params.get('limit'), SEARCH_PAGE_SIZE, SEARCH_PAGE_SIZE_MAX)
+                after = decode_keyset_cursor(params.get('cursor'), (int, float))
+            except ValueError:
                 return {
-                    'statusCode': 200,
+                    'statusCode': 400,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'contacts': contacts}),
+                    'body': json.dumps({'error': 'Invalid pagination parameters'}),
+                    'isBase64Encoded': False
+                }
+            if not query_text:
+                return {
+                    'statusCode': 400,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'Search query is required'}),
                     'isBase64Encoded': False
                 }
             
-            elif path == 'messages':
-                chat_id = params.get('chat_id')
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(f"""
+            cursor_filter = ''
+            query_params: List[Any] = [query_text, query_text]
+            if after is not None:
+                cursor_filter = 'AND (ts_rank(m.search_vector, q.query)::float8, m.id) < (%s, %s)'
+                query_params += [after[0], after[1]]
+            query_params.append(limit + 1)
+            
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                query_params.insert(2, get_user_chat_ids(cur, schema, user_id))
+                cur.execute(f"""
+                    WITH q AS (
+                        SELECT websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s) AS query
+                    ), hits AS (
                         SELECT m.id, m.chat_id, m.sender_id, m.content, m.created_at,
-                               COALESCE(m.is_ai, false) as is_ai,
-                               u.name as sender_name, u.avatar as sender_avatar
-                        FROM {schema}.messages m
-                        LEFT JOIN {schema}.users u ON u.id = m.sender_id
-                        WHERE m.chat_id = %s
-                        ORDER BY m.created_at ASC
-                        LIMIT 100
-                    """, (chat_id,))
-                    messages = [dict(row) for row in cur.fetchall()]
-                    
-                    for msg in messages:
-                        if msg['created_at']:
-                            msg['created_at'] = msg['created_at'].isoformat()
-                
+                               ts_rank(m.search_vector, q.query)::float8 AS rank
+                        FROM {schema}.messages m, q
+                        WHERE m.search_vector @@ q.query
+                          AND m.chat_id = ANY(%s)
+                          {cursor_filter}
+                        ORDER BY rank DESC, m.id DESC
+                        LIMIT %s
+                    )
+                    SELECT hits.id, hits.chat_id, hits.sender_id, hits.created_at, hits.rank,
+                           ts_headline('russian', hits.content, q.query, 'MaxFragments=1, MaxWords=20, MinWords=5') AS snippet
+                    FROM hits, q
+                    ORDER BY hits.rank DESC, hits.id DESC
+                """, query_params)
+                results = [dict(row) for row in cur.fetchall()]
+            
+            next_cursor = None
+            if len(results) > limit:
+                results = results[:limit]
+                next_cursor = encode_cursor([results[-1]['rank'], results[-1]['id']])
+            for result in results:
+                result['created_at'] = result['created_at'].isoformat() if result['created_at'] else None
+            
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'results': results, 'next_cursor': next_cursor}),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'metrics':
+            pool = get_db_pool()
+            extra = {f'chattix_db_pool_{key}': value for key, value in pool.stats.items()}
+            for cache_name, cache in (('profile', profile_cache), ('phone', phone_cache), ('membership', membership_cache)):
+                for key, value in cache.stats.items():
+                    extra[f'chattix_cache_{cache_name}_{key}'] = value
+            for key, value in ai_response_cache.stats.items():
+                extra[f'chattix_cache_ai_response_{key}'] = value
+            for key, value in presence_stats.items():
+                extra[f'chattix_presence_{key}'] = value
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'text/plain; version=0.0.4', 'Access-Control-Allow-Origin': '*'},
+                'body': metrics.render(extra),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'cache_stats':
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'profile': profile_cache.stats,
+                    'phone': phone_cache.stats,
+                    'membership': membership_cache.stats,
+                    'ai_response': ai_response_cache.stats,
+                    'db_pool': get_db_pool().stats
+                }),
+                'isBase64Encoded': False
+            }
+        
+        elif path == 'search_user':
+            search_phone = params.get('phone', '')
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                user = get_user_by_phone(cur, schema, search_phone)
+            
+            if user:
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'messages': messages}),
+                    'body': json.dumps({'user': dict(user)}),
                     'isBase64Encoded': False
                 }
-            
-            elif path == 'search_user':
-                search_phone = params.get('phone', '')
-                with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                    cur.execute(f"""
-                        SELECT id, name, phone, avatar
-                        FROM {schema}.users
-                        WHERE phone = %s
-                    """, (search_phone,))
-                    user = cur.fetchone()
-                
-                if user:
-                    return {
-                        'statusCode': 200,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'user': dict(user)}),
-                        'isBase64Encoded': False
-                    }
-                else:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'User not found'}),
-                        'isBase64Encoded': False
-                    }
-        
+            else:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'User not found'}),
+                    'isBase64Encoded': False
+                }
+    
+    return {
+        'statusCode': 400,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Invalid request'}),
+        'isBase64Encoded': False
+    }
+
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: API для работы с чатами, сообщениями, контактами
+    Args: event с httpMethod, body, queryStringParameters
+    Returns: HTTP response с данными из базы
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
         return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid request'}),
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
             'isBase64Encoded': False
         }
     
+    headers = event.get('headers', {})
+    user_id = headers.get('x-user-id') or headers.get('X-User-Id')
+    params = event.get('queryStringParameters', {}) or {}
+    body_data = json.loads(event.get('body', '{}')) if method == 'POST' else {}
+    
+    conn, schema = get_db_connection()
+    
+    try:
+        return route_request(conn, schema, method, params, body_data, user_id)
     finally:
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
@@ -0,0 +1,248 @@
+'''
+Нагрузочный тест функции api: handler вызывается в процессе против локального Postgres.
+
+Засевает пользователей, чаты разного размера, контакты и сообщения, затем
+1) прогоняет каждое действие последовательно --iterations раз;
+2) запускает смешанную нагрузку из --workers потоков на --duration секунд.
+Для send_message с should_reply поднимается заглушка AI (--ai-delay, доля --ai-ratio).
+Печатает пропускную способность и p50/p95/p99 по действиям; --json сохраняет отчёт для сравнения между сборками.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_api.py --messages 2000000
+'''
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, Any, List
+
+import psycopg2
+
+from harness import WORDS, LatencyStats, StubAIServer, create_database, database_url, invoke, load_function, print_report
+from harness import seed_chats, seed_contacts, seed_messages, seed_users
+
+def parse_chat_sizes(value: str) -> List[int]:
+    sizes = []
+    for part in value.split(','):
+        size, count = part.split(':')
+        sizes += [int(size)] * int(count)
+    return sizes
+
+def load_memberships(url: str) -> Dict[str, Any]:
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT chat_id, user_id FROM chat_members")
+            chat_members: Dict[int, List[int]] = {}
+            for chat_id, user_id in cur.fetchall():
+                chat_members.setdefault(chat_id, []).append(user_id)
+    finally:
+        conn.close()
+    return {'chat_members': chat_members, 'chats': list(chat_members)}
+
+class Workload:
+    '''
+    Набор действий клиента. Каждое выбирает случайный чат и его участника, чтобы запросы были осмысленными.
+    '''
+
+    def __init__(self, api, data: Dict[str, Any], ai_ratio: float, seed: int):
+        self.api = api
+        self.data = data
+        self.ai_ratio = ai_ratio
+        self.rng = random.Random(seed)
+        self.sync_tokens: Dict[int, str] = {}
+
+    def pick(self):
+        chat_id = self.rng.choice(self.data['chats'])
+        return chat_id, self.rng.choice(self.data['chat_members'][chat_id])
+
+    def get_chats(self):
+        _, user_id = self.pick()
+        return invoke(self.api, 'GET', {'path': 'chats'}, user_id=user_id)
+
+    def get_messages(self):
+        chat_id, user_id = self.pick()
+        return invoke(self.api, 'GET', {'path': 'messages', 'chat_id': chat_id}, user_id=user_id)
+
+    def get_messages_older(self):
+        chat_id, user_id = self.pick()
+        status, data = invoke(self.api, 'GET', {'path': 'messages', 'chat_id': chat_id, 'limit': 50}, user_id=user_id)
+        if status == 200 and data.get('messages'):
+            return invoke(self.api, 'GET', {'path': 'messages', 'chat_id': chat_id, 'before_id': data['messages'][0]['id']}, user_id=user_id)
+        return status, data
+
+    def get_contacts(self):
+        _, user_id = self.pick()
+        return invoke(self.api, 'GET', {'path': 'contacts'}, user_id=user_id)
+
+    def search_messages(self):
+        _, user_id = self.pick()
+        return invoke(self.api, 'GET', {'path': 'search_messages', 'q': self.rng.choice(WORDS)}, user_id=user_id)
+
+    def sync(self):
+        _, user_id = self.pick()
+        params = {'path': 'sync'}
+        if user_id in self.sync_tokens:
+            params['token'] = self.sync_tokens[user_id]
+        status, data = invoke(self.api, 'GET', params, user_id=user_id)
+        if status == 200:
+            self.sync_tokens[user_id] = data['sync_token']
+        return status, data
+
+    def send_message(self):
+        chat_id, user_id = self.pick()
+        return invoke(self.api, 'POST', body={
+            'action': 'send_message', 'chat_id': chat_id, 'sender_id': user_id,
+            'content': f'Нагрузочное сообщение {self.rng.randrange(10 ** 9)}',
+            'should_reply': self.rng.random() < self.ai_ratio
+        }, user_id=user_id)
+
+    def heartbeat(self):
+        _, user_id = self.pick()
+        return invoke(self.api, 'POST', body={'action': 'update_online_status', 'user_id': user_id, 'is_online': True}, user_id=user_id)
+
+    def mark_read(self):
+        chat_id, user_id = self.pick()
+        return invoke(self.api, 'POST', body={'action': 'mark_read', 'chat_id': chat_id, 'user_id': user_id}, user_id=user_id)
+
+    def app_open_batch(self):
+        chat_id, user_id = self.pick()
+        return invoke(self.api, 'POST', body={'action': 'batch', 'requests': [
+            {'method': 'POST', 'body': {'action': 'update_online_status', 'user_id': user_id, 'is_online': True}},
+            {'method': 'GET', 'params': {'path': 'chats'}},
+            {'method': 'GET', 'params': {'path': 'contacts'}},
+            {'method': 'GET', 'params': {'path': 'messages', 'chat_id': str(chat_id)}}
+        ]}, user_id=user_id)
+
+# Доли действий в смешанной нагрузке: чтение чатов и сообщений и heartbeat преобладают
+MIX = (
+    ('get_messages', 30), ('get_chats', 15), ('heartbeat', 20), ('send_message', 12), ('sync', 8),
+    ('get_contacts', 5), ('mark_read', 5), ('get_messages_older', 3), ('search_messages', 1), ('app_open_batch', 1)
+)
+
+def run_action(workload: Workload, stats: LatencyStats, action: str) -> None:
+    started = time.perf_counter()
+    try:
+        status, _ = getattr(workload, action)()
+        ok = status < 400
+    except Exception:
+        ok = False
+    stats.record(action, time.perf_counter() - started, ok)
+
+def run_sequential(api, data: Dict[str, Any], iterations: int, ai_ratio: float) -> List[Dict[str, Any]]:
+    workload = Workload(api, data, ai_ratio, seed=1)
+    stats = LatencyStats()
+    for action, _ in MIX:
+        for _ in range(iterations):
+            run_action(workload, stats, action)
+    rows = stats.report()
+    # В последовательном прогоне пропускная способность действия — обратная средней задержке, а не общий rps
+    for row in rows:
+        total = sum(stats.samples[row['action']])
+        row['rps'] = row['count'] / total if total else 0.0
+    return rows
+
+def run_mixed(api, data: Dict[str, Any], workers: int, duration: float, ai_ratio: float) -> List[Dict[str, Any]]:
+    stats = LatencyStats()
+    deadline = time.monotonic() + duration
+    actions = [action for action, _ in MIX]
+    weights = [weight for _, weight in MIX]
+
+    def worker(index: int) -> None:
+        workload = Workload(api, data, ai_ratio, seed=100 + index)
+        while time.monotonic() < deadline:
+            run_action(workload, stats, workload.rng.choices(actions, weights)[0])
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    rows = stats.report(elapsed)
+    total = sum(row['count'] for row in rows)
+    rows.append({'action': 'TOTAL', 'count': total, 'errors': sum(row['errors'] for row in rows),
+                 'rps': total / elapsed, 'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0})
+    return rows
+
+def drain_ai_queue(api, url: str) -> List[Dict[str, Any]]:
+    '''
+    Дожидается разбора очереди AI-заданий, пока заглушка ещё отвечает, и возвращает
+    число заданий по статусам и задержку от постановки в очередь до ответа в чате.
+    '''
+    while sum(api.drain_ai_jobs(max_jobs=1000).values()):
+        pass
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT j.status, COUNT(*),
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM r.created_at - j.created_at)),
+                       percentile_cont(0.95) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM r.created_at - j.created_at)),
+                       percentile_cont(0.99) WITHIN GROUP (ORDER BY EXTRACT(EPOCH FROM r.created_at - j.created_at)),
+                       MAX(EXTRACT(EPOCH FROM r.created_at - j.created_at))
+                FROM ai_jobs j
+                LEFT JOIN messages r ON r.id = j.reply_message_id
+                GROUP BY j.status
+                ORDER BY j.status
+            """)
+            return [{'action': f'ai_job {status}', 'count': count, 'errors': count if status != 'done' else 0, 'rps': 0.0,
+                     'p50_ms': (p50 or 0) * 1000, 'p95_ms': (p95 or 0) * 1000, 'p99_ms': (p99 or 0) * 1000, 'max_ms': float(top or 0) * 1000}
+                    for status, count, p50, p95, p99, top in cur.fetchall()]
+    finally:
+        conn.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench')
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже засеянную базу --db-name')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--chats', default='2:2000,10:200,100:30,1000:5,5000:1', help='размер:количество через запятую')
+    parser.add_argument('--contacts', type=int, default=50, help='контактов на пользователя')
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--ai-delay', type=float, default=0.5)
+    parser.add_argument('--ai-ratio', type=float, default=0.05)
+    parser.add_argument('--json', help='куда сохранить отчёт')
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    if args.skip_seed:
+        url = database_url(args.admin_url, args.db_name)
+    else:
+        print(f'Создаю базу {args.db_name} и применяю миграции')
+        url = create_database(args.admin_url, args.db_name)
+        rng = random.Random(42)
+        conn = psycopg2.connect(url)
+        try:
+            user_ids = seed_users(conn, args.users)
+            chat_ids = seed_chats(conn, user_ids, parse_chat_sizes(args.chats), rng)
+            seed_contacts(conn, user_ids, args.contacts, rng)
+            print(f'Засеваю {args.messages} сообщений')
+            seed_messages(conn, chat_ids, user_ids, args.messages, log=print)
+        finally:
+            conn.close()
+
+    data = load_memberships(url)
+    with StubAIServer(delay=args.ai_delay) as stub:
+        api = load_function('api', DATABASE_URL=url, OPENAI_API_KEY='bench', OPENAI_API_URL=stub.url,
+                            DB_POOL_MAX_SIZE=str(max(args.workers, 4)))
+        sequential = run_sequential(api, data, args.iterations, args.ai_ratio)
+        print_report(f'Последовательно, по {args.iterations} вызовов', sequential)
+        mixed = run_mixed(api, data, args.workers, args.duration, args.ai_ratio)
+        print_report(f'Смешанная нагрузка: {args.workers} потоков, {args.duration:.0f} с', mixed)
+        ai_jobs = drain_ai_queue(api, url)
+        print_report(f'Очередь AI: запросов к заглушке {len(stub.requests)}, задержка от вопроса до ответа', ai_jobs)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'sequential': sequential, 'mixed': mixed, 'ai_jobs': ai_jobs, 'args': vars(args)}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
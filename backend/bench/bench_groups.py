@@ -0,0 +1,82 @@
+'''
+Замер создания группы и группового чата на 10, 1 000 и 10 000 участников.
+
+Сравнивает action create_group и create_chat (пакетная вставка участников через execute_values)
+с прежней схемой — по INSERT на участника в group_members и chat_participants — на отдельном соединении.
+На локальном сокете круговая задержка почти нулевая; с базой по сети разрыв растёт на 2N RTT.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_groups.py
+'''
+import argparse
+import os
+import random
+from typing import Dict, Any, List
+
+import psycopg2
+
+from harness import LatencyStats, create_database, database_url, invoke, load_function, print_report, seed_users
+
+def create_group_row_by_row(conn, created_by: int, member_ids: List[int]) -> None:
+    '''
+    Создание группы до пакетной вставки: два INSERT на каждого участника.
+    '''
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO groups (name, created_by) VALUES (%s, %s) RETURNING id", ('Группа', created_by))
+        group_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO chats (type, group_id) VALUES ('group', %s) RETURNING id", (group_id,))
+        chat_id = cur.fetchone()[0]
+        for member_id in [created_by] + member_ids:
+            cur.execute(
+                "INSERT INTO group_members (group_id, user_id, role) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                (group_id, member_id, 'admin' if member_id == created_by else 'member')
+            )
+            cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (chat_id, member_id))
+    conn.commit()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench_groups')
+    parser.add_argument('--sizes', default='10,1000,10000')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--no-baseline', action='store_true', help='не замерять прежнюю вставку по строке')
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    url = create_database(args.admin_url, args.db_name)
+    conn = psycopg2.connect(url)
+    user_ids = seed_users(conn, max(sizes) + 1)
+    api = load_function('api', DATABASE_URL=url)
+
+    rng = random.Random(4)
+    stats = LatencyStats()
+    for size in sizes:
+        for _ in range(args.iterations):
+            created_by, *members = rng.sample(user_ids, size + 1)
+            # Повторы в списке участников проверяют дедупликацию
+            member_ids = members + members[:size // 10]
+            with stats.timed(f'create_group {size}'):
+                status, data = invoke(api, 'POST', body={
+                    'action': 'create_group', 'name': 'Группа', 'created_by': created_by, 'member_ids': member_ids
+                }, user_id=created_by)
+                assert status == 200, data
+            with stats.timed(f'create_chat {size}'):
+                status, data = invoke(api, 'POST', body={
+                    'action': 'create_chat', 'name': 'Чат', 'is_group': True, 'members': [created_by] + member_ids
+                }, user_id=created_by)
+                assert status == 200, data
+            if not args.no_baseline:
+                with stats.timed(f'row_by_row {size}'):
+                    create_group_row_by_row(conn, created_by, member_ids)
+    conn.close()
+
+    rows: List[Dict[str, Any]] = stats.report()
+    for row in rows:
+        row['rps'] = row['count'] / sum(stats.samples[row['action']])
+    rows.sort(key=lambda row: (int(row['action'].split()[1]), row['action']))
+    print_report(f'Создание группы, по {args.iterations} раз на размер (rps — групп в секунду)', rows)
+
+if __name__ == '__main__':
+    main()
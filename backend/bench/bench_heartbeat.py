@@ -0,0 +1,137 @@
+'''
+Нагрузочный тест heartbeat: до и после переноса присутствия в user_presence.
+
+before — прежняя запись: UPDATE users SET is_online, last_seen на каждый heartbeat;
+after — action update_online_status (unlogged user_presence, поглощение повторов, пакетный flush в users);
+after-no-coalesce — то же с PRESENCE_COALESCE_SECONDS=0, каждый heartbeat пишется в user_presence.
+
+Клиенты шлют heartbeat за случайных пользователей из --active без пауз --duration секунд.
+Кроме задержек печатается, сколько строк users обновлено, сколько мёртвых версий осталось и объём WAL.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_heartbeat.py
+'''
+import argparse
+import os
+import random
+import threading
+import time
+from typing import Dict, Any, List
+
+import psycopg2
+
+from harness import LatencyStats, create_database, invoke, load_function, print_report, seed_users
+
+TABLES = ('users', 'user_presence')
+
+def table_counters(url: str) -> Dict[str, int]:
+    # Статистика других backend'ов публикуется с задержкой до секунды
+    time.sleep(1.5)
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT relname, n_tup_upd + n_tup_ins, n_tup_hot_upd, n_dead_tup
+                FROM pg_stat_user_tables WHERE relname = ANY(%s)
+            """, (list(TABLES),))
+            counters = {}
+            for relname, written, hot, dead in cur.fetchall():
+                counters[f'{relname}_written'] = written
+                counters[f'{relname}_hot'] = hot
+                counters[f'{relname}_dead'] = dead
+            cur.execute("SELECT pg_current_wal_lsn() - '0/0'::pg_lsn")
+            counters['wal_bytes'] = int(cur.fetchone()[0])
+        return counters
+    finally:
+        conn.close()
+
+def run_clients(send, active: List[int], workers: int, duration: float, stats: LatencyStats, name: str) -> float:
+    deadline = time.monotonic() + duration
+
+    def worker(index: int) -> None:
+        rng = random.Random(index)
+        state = {}
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                send(state, rng.choice(active))
+                ok = True
+            except Exception:
+                ok = False
+            stats.record(name, time.perf_counter() - started, ok)
+        if 'conn' in state:
+            state['conn'].close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench_heartbeat')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--active', type=int, default=10000, help='сколько пользователей онлайн шлют heartbeat')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20.0)
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    url = create_database(args.admin_url, args.db_name)
+    conn = psycopg2.connect(url)
+    user_ids = seed_users(conn, args.users)
+    conn.close()
+    active = random.Random(8).sample(user_ids, min(args.active, len(user_ids)))
+
+    def before(state: Dict[str, Any], user_id: int) -> None:
+        if 'conn' not in state:
+            state['conn'] = psycopg2.connect(url)
+        with state['conn'].cursor() as cur:
+            cur.execute("UPDATE users SET is_online = %s, last_seen = CURRENT_TIMESTAMP WHERE id = %s", (True, user_id))
+        state['conn'].commit()
+
+    def through_handler(**env):
+        api = load_function('api', DATABASE_URL=url, DB_POOL_MAX_SIZE=str(max(args.workers, 4)), **env)
+
+        def send(state: Dict[str, Any], user_id: int) -> None:
+            status, data = invoke(api, 'POST', body={'action': 'update_online_status', 'user_id': user_id, 'is_online': True}, user_id=user_id)
+            if status != 200:
+                raise RuntimeError(data)
+        return api, send
+
+    modes = [
+        ('before', lambda: (None, before)),
+        ('after', lambda: through_handler(PRESENCE_COALESCE_SECONDS='60', PRESENCE_FLUSH_INTERVAL='60')),
+        ('after-no-coalesce', lambda: through_handler(PRESENCE_COALESCE_SECONDS='0', PRESENCE_FLUSH_INTERVAL='5'))
+    ]
+
+    stats = LatencyStats()
+    counters: Dict[str, Dict[str, int]] = {}
+    elapsed: Dict[str, float] = {}
+    for name, make_sender in modes:
+        api, send = make_sender()
+        start = table_counters(url)
+        elapsed[name] = run_clients(send, active, args.workers, args.duration, stats, name)
+        if api is not None:
+            # Хвост присутствия, который иначе перенёс бы следующий плановый flush_presence
+            invoke(api, 'POST', body={'action': 'flush_presence'})
+        end = table_counters(url)
+        counters[name] = {key: end.get(key, 0) - start.get(key, 0) for key in end}
+        counters[name]['users_dead_total'] = end.get('users_dead', 0)
+
+    rows = stats.report()
+    for row in rows:
+        row['rps'] = row['count'] / elapsed[row['action']]
+    print_report(f'Heartbeat: {args.workers} потоков, {args.duration:.0f} с на режим, {len(active)} активных пользователей', rows)
+    print(f"\n{'mode':<28}{'users upd':>12}{'users HOT':>12}{'users dead':>12}{'presence upd':>14}{'WAL MB':>10}")
+    for name, _ in modes:
+        c = counters[name]
+        print(f"{name:<28}{c.get('users_written', 0):>12}{c.get('users_hot', 0):>12}{c['users_dead_total']:>12}"
+              f"{c.get('user_presence_written', 0):>14}{c['wal_bytes'] / 2 ** 20:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+'''
+Пропускная способность импорта истории (action import_messages): строк в секунду на разных объёмах.
+
+Для каждого размера из --sizes генерируется история из двух участников за последние 90 дней
+в NDJSON и CSV и импортируется в новый чат через handler. Отдельно замеряется разбор и проверка строк
+без базы (parse) и, для размеров до --baseline-max, прежний путь — send_message на каждое сообщение.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_import.py
+'''
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List
+
+import psycopg2
+
+from harness import WORDS, create_database, invoke, load_function, seed_chats, seed_users
+
+def generate_history(count: int, members: List[int], rng: random.Random) -> List[Dict[str, Any]]:
+    start = datetime.now() - timedelta(days=90)
+    step = timedelta(days=89) / count
+    return [{
+        'sender_id': rng.choice(members),
+        'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))),
+        'created_at': (start + step * i).isoformat(timespec='seconds')
+    } for i in range(count)]
+
+def to_ndjson(history: List[Dict[str, Any]]) -> str:
+    return '\n'.join(json.dumps(record, ensure_ascii=False) for record in history)
+
+def to_csv(history: List[Dict[str, Any]]) -> str:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['sender_id', 'content', 'created_at'])
+    writer.writeheader()
+    writer.writerows(history)
+    return buffer.getvalue()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench_import')
+    parser.add_argument('--sizes', default='1000,10000,100000,500000')
+    parser.add_argument('--baseline-max', type=int, default=10000, help='до какого размера замерять send_message по одному')
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    url = create_database(args.admin_url, args.db_name)
+    rng = random.Random(19)
+    conn = psycopg2.connect(url)
+    user_ids = seed_users(conn, 2)
+    api = load_function('api', DATABASE_URL=url)
+
+    print(f"{'rows':>8}  {'mode':<14}{'seconds':>10}{'rows/s':>12}{'payload MB':>12}")
+    for size in [int(size) for size in args.sizes.split(',')]:
+        history = generate_history(size, user_ids, rng)
+        payloads = {'ndjson': to_ndjson(history), 'csv': to_csv(history)}
+        results = []
+
+        members = set(user_ids)
+        started = time.perf_counter()
+        for record, line_no in api.parse_import_rows(payloads['ndjson'], 'ndjson'):
+            api.normalize_import_row(record, 0, members, line_no)
+        results.append(('parse', time.perf_counter() - started, len(payloads['ndjson'].encode('utf-8'))))
+
+        for data_format, data in payloads.items():
+            chat_id = seed_chats(conn, user_ids, [2], rng)[0]
+            started = time.perf_counter()
+            status, result = invoke(api, 'POST', body={
+                'action': 'import_messages', 'chat_id': chat_id, 'format': data_format, 'data': data
+            }, user_id=user_ids[0])
+            elapsed = time.perf_counter() - started
+            if status != 200 or result['imported'] != size:
+                raise RuntimeError(result)
+            results.append((f'import {data_format}', elapsed, len(data.encode('utf-8'))))
+
+        if size <= args.baseline_max:
+            chat_id = seed_chats(conn, user_ids, [2], rng)[0]
+            started = time.perf_counter()
+            for record in history:
+                invoke(api, 'POST', body={
+                    'action': 'send_message', 'chat_id': chat_id, 'sender_id': record['sender_id'], 'content': record['content']
+                }, user_id=record['sender_id'])
+            results.append(('send_message', time.perf_counter() - started, 0))
+
+        for mode, elapsed, payload in results:
+            print(f'{size:>8}  {mode:<14}{elapsed:>10.2f}{size / elapsed:>12.0f}{payload / 2 ** 20:>12.1f}')
+    conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+'''
+Задержка поиска по сообщениям (GET ?path=search_messages) на корпусе в миллионы строк.
+
+Корпус: --messages сообщений из словаря WORDS (каждое слово встречается примерно в каждом седьмом
+сообщении) плюс по одному редкому слову tagN из --rare-tokens. Запросы по видам:
+rare — одно редкое слово; rare_and_word — редкое слово вместе с частым;
+common — одно частое слово, худший случай ранжирования; common_page2 — вторая страница по курсору.
+
+С --max-p95-ms завершается с кодом 1, если p95 любого из видов --gate выше порога.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_search.py --messages 3000000
+'''
+import argparse
+import os
+import random
+import sys
+from typing import Dict, Any, List
+
+import psycopg2
+
+from harness import WORDS, LatencyStats, create_database, database_url, invoke, load_function, print_report
+from harness import seed_chats, seed_messages, seed_users
+
+def search(api, user_id: int, q: str, cursor: str = None):
+    params = {'path': 'search_messages', 'q': q}
+    if cursor:
+        params['cursor'] = cursor
+    status, data = invoke(api, 'GET', params, user_id=user_id)
+    if status != 200:
+        raise RuntimeError(data)
+    return data
+
+def run_queries(api, members: Dict[int, List[int]], rare_tokens: int, iterations: int, seed: int = 13) -> LatencyStats:
+    rng = random.Random(seed)
+    chats = list(members)
+    stats = LatencyStats()
+    for _ in range(iterations):
+        user_id = rng.choice(members[rng.choice(chats)])
+        tag = f'tag{rng.randrange(rare_tokens)}'
+        word = rng.choice(WORDS)
+        with stats.timed('rare'):
+            search(api, user_id, tag)
+        with stats.timed('rare_and_word'):
+            search(api, user_id, f'{tag} {word}')
+        with stats.timed('common'):
+            first = search(api, user_id, word)
+        if first['next_cursor']:
+            with stats.timed('common_page2'):
+                search(api, user_id, word, first['next_cursor'])
+    return stats
+
+def load_members(url: str) -> Dict[int, List[int]]:
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT chat_id, array_agg(user_id) FROM chat_members GROUP BY chat_id")
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+def seed_corpus(url: str, users: int, chat_sizes: List[int], messages: int, rare_tokens: int, log=None) -> None:
+    rng = random.Random(42)
+    conn = psycopg2.connect(url)
+    try:
+        user_ids = seed_users(conn, users)
+        chat_ids = seed_chats(conn, user_ids, chat_sizes, rng)
+        seed_messages(conn, chat_ids, user_ids, messages, rare_tokens=rare_tokens, log=log)
+    finally:
+        conn.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench_search')
+    parser.add_argument('--skip-seed', action='store_true', help='использовать уже засеянную базу --db-name')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=2000, help='чатов; у каждого пользователя в среднем chats * members / users')
+    parser.add_argument('--members', type=int, default=20, help='участников в чате')
+    parser.add_argument('--messages', type=int, default=3_000_000)
+    parser.add_argument('--rare-tokens', type=int, default=100_000)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--max-p95-ms', type=float)
+    parser.add_argument('--gate', default='rare,rare_and_word', help='виды запросов, к которым применяется --max-p95-ms')
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    if args.skip_seed:
+        url = database_url(args.admin_url, args.db_name)
+    else:
+        print(f'Создаю базу {args.db_name} и засеваю {args.messages} сообщений')
+        url = create_database(args.admin_url, args.db_name)
+        seed_corpus(url, args.users, [args.members] * args.chats, args.messages, args.rare_tokens, log=print)
+
+    api = load_function('api', DATABASE_URL=url)
+    stats = run_queries(api, load_members(url), args.rare_tokens, args.iterations)
+    rows: List[Dict[str, Any]] = stats.report()
+    for row in rows:
+        row['rps'] = row['count'] / sum(stats.samples[row['action']])
+    print_report(f'Поиск по {args.messages} сообщениям, {args.iterations} итераций', rows)
+
+    if args.max_p95_ms is not None:
+        gated = set(args.gate.split(','))
+        slow = [row for row in rows if row['action'] in gated and row['p95_ms'] > args.max_p95_ms]
+        for row in slow:
+            print(f"p95 {row['action']} = {row['p95_ms']:.1f} ms > {args.max_p95_ms} ms")
+        if slow:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+'''
+Нагрузочный тест функции upload: handler вызывается в процессе, файлы пишутся во временный каталог.
+
+Для каждого размера из --sizes замеряются загрузка одним запросом (до 10 МБ в base64), загрузка
+по частям (init, append по CHUNK_SIZE, finalize — в сумме и по шагам) и повторная загрузка того же
+содержимого, которую init отдаёт сразу по sha256. Затем --workers потоков --duration секунд грузят
+файлы по частям параллельно, и сборка мусора проходит по --gc-blobs старым blob.
+
+    BENCH_DATABASE_URL=postgresql://postgres@localhost/postgres python backend/bench/bench_upload.py
+'''
+import argparse
+import base64
+import hashlib
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import List
+
+from harness import LatencyStats, create_database, invoke, load_function, print_report
+
+def chunked_upload(upload, data: bytes, stats: LatencyStats, prefix: str, sha256: str = None) -> dict:
+    with stats.timed(f'{prefix} init'):
+        status, init = invoke(upload, 'POST', body={
+            'action': 'init', 'name': 'file.bin', 'type': 'application/octet-stream', 'size': len(data), 'sha256': sha256
+        })
+    if status != 200:
+        raise RuntimeError(init)
+    if init.get('exists'):
+        return init
+    chunk_size = init['chunk_size']
+    for offset in range(0, len(data), chunk_size):
+        with stats.timed(f'{prefix} append'):
+            status, result = invoke(upload, 'POST', body={
+                'action': 'append', 'upload_id': init['upload_id'], 'offset': offset,
+                'chunk': base64.b64encode(data[offset:offset + chunk_size]).decode('ascii')
+            })
+        if status != 200:
+            raise RuntimeError(result)
+    with stats.timed(f'{prefix} finalize'):
+        status, result = invoke(upload, 'POST', body={'action': 'finalize', 'upload_id': init['upload_id']})
+    if status != 200:
+        raise RuntimeError(result)
+    return result
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--admin-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--db-name', default='chattix_bench_upload')
+    parser.add_argument('--sizes', default='65536,1048576,8388608', help='размеры файлов в байтах')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--gc-blobs', type=int, default=5000)
+    args = parser.parse_args()
+    if not args.admin_url:
+        parser.error('нужен --admin-url или BENCH_DATABASE_URL')
+
+    url = create_database(args.admin_url, args.db_name)
+    upload = load_function('upload', DATABASE_URL=url, BLOB_GC_TOKEN='bench')
+    storage = tempfile.mkdtemp(prefix='chattix_bench_upload_')
+    upload.UPLOAD_DIR = storage
+    upload.PARTIAL_DIR = os.path.join(storage, '.partial')
+    upload.BLOB_DIR = os.path.join(storage, 'blobs')
+    print(f'Файлы пишутся в {storage}')
+
+    rng = random.Random(18)
+    for size in [int(size) for size in args.sizes.split(',')]:
+        stats = LatencyStats()
+        for _ in range(args.iterations):
+            data = rng.randbytes(size)
+            with stats.timed('single request'):
+                status, result = invoke(upload, 'POST', body={
+                    'file': base64.b64encode(data).decode('ascii'), 'name': 'file.bin', 'type': 'application/octet-stream'
+                })
+            if status != 200:
+                raise RuntimeError(result)
+            data = rng.randbytes(size)
+            with stats.timed('chunked total'):
+                chunked_upload(upload, data, stats, 'chunked')
+            with stats.timed('dedup total'):
+                result = chunked_upload(upload, data, stats, 'dedup', hashlib.sha256(data).hexdigest())
+            if not result.get('exists'):
+                raise RuntimeError('повторная загрузка не нашла blob по sha256')
+        rows = stats.report()
+        for row in rows:
+            row['rps'] = row['count'] / sum(stats.samples[row['action']])
+        print_report(f'Файл {size} байт, {args.iterations} загрузок (rps — последовательных вызовов в секунду)', rows)
+
+    stats = LatencyStats()
+    deadline = time.monotonic() + args.duration
+    size = int(args.sizes.split(',')[1 if ',' in args.sizes else 0])
+
+    def worker(index: int) -> None:
+        worker_rng = random.Random(index)
+        while time.monotonic() < deadline:
+            try:
+                with stats.timed('chunked total'):
+                    chunked_upload(upload, worker_rng.randbytes(size), stats, 'chunked')
+            except RuntimeError:
+                # Ошибка уже учтена в errors, поток продолжает нагрузку
+                continue
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print_report(f'Параллельно: {args.workers} потоков, файлы по {size} байт', stats.report(time.perf_counter() - started))
+
+    # Сборка мусора: старые blob без ссылок из messages
+    old = time.time() - upload.BLOB_GC_GRACE_SECONDS - 3600
+    for _ in range(args.gc_blobs):
+        sha256 = hashlib.sha256(rng.randbytes(32)).hexdigest()
+        path = upload.blob_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'x')
+        os.utime(path, (old, old))
+    stats = LatencyStats()
+    with stats.timed('gc'):
+        status, result = invoke(upload, 'POST', body={'action': 'gc'}, headers={'X-Maintenance-Token': 'bench'})
+    if status != 200:
+        raise RuntimeError(result)
+    rows: List[dict] = stats.report()
+    print_report(f"Сборка мусора: просмотрено {result['scanned']}, удалено {result['deleted']}", rows)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Очередь AI-ответов против заглушки chat-completions на http.server.
+'''
+import time
+
+from harness import invoke
+
+def wait_for(predicate, timeout: float = 10.0, interval: float = 0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(interval)
+    raise AssertionError('условие не выполнилось за отведённое время')
+
+def ai_replies(db, chat_id: int):
+    with db.cursor() as cur:
+        cur.execute("SELECT content FROM messages WHERE chat_id = %s AND is_ai ORDER BY id", (chat_id,))
+        return [row[0] for row in cur.fetchall()]
+
+def job_state(db, job_id: int):
+    with db.cursor() as cur:
+        cur.execute("SELECT status, attempts, last_error FROM ai_jobs WHERE id = %s", (job_id,))
+        return cur.fetchone()
+
+def send(api, chat_id: int, user_id: int, content: str):
+    return invoke(api, 'POST', body={
+        'action': 'send_message', 'chat_id': chat_id, 'sender_id': user_id, 'content': content, 'should_reply': True
+    }, user_id=user_id)
+
+def test_send_message_does_not_wait_for_ai(load_api, stub_ai, db, chat):
+    stub = stub_ai(delay=1.0)
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL=stub.url)
+    chat_id, (user_id, _) = chat
+
+    started = time.perf_counter()
+    status, data = send(api, chat_id, user_id, 'Как дела?')
+    elapsed = time.perf_counter() - started
+
+    assert status == 200
+    assert 'ai_job_id' in data
+    assert elapsed < stub.delay / 2
+    assert wait_for(lambda: ai_replies(db, chat_id)) == ['Ответ: Как дела?']
+    assert wait_for(lambda: job_state(db, data['ai_job_id'])[0] == 'done')
+
+def test_replies_follow_question_order(load_api, stub_ai, db, chat):
+    stub = stub_ai(delay=0.1)
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL=stub.url, AI_WORKER_CONCURRENCY=4)
+    chat_id, (user_id, _) = chat
+
+    questions = [f'Вопрос {i}' for i in range(4)]
+    for question in questions:
+        assert send(api, chat_id, user_id, question)[0] == 200
+
+    # Фоновый разбор мог завершиться до постановки последних заданий — добираем их явно,
+    # как это делает action process_ai_jobs по расписанию
+    def all_answered():
+        api.drain_ai_jobs()
+        replies = ai_replies(db, chat_id)
+        return replies if len(replies) == len(questions) else None
+    assert wait_for(all_answered) == [f'Ответ: {question}' for question in questions]
+    assert [request['messages'][-1]['content'] for request in stub.requests] == questions
+
+def test_failed_request_is_retried(load_api, stub_ai, db, chat):
+    stub = stub_ai(fail_first=1)
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL=stub.url)
+    chat_id, (user_id, _) = chat
+
+    status, data = send(api, chat_id, user_id, 'Повтори')
+    assert status == 200
+    job_id = data['ai_job_id']
+    assert wait_for(lambda: job_state(db, job_id)[0] == 'pending' and job_state(db, job_id)[1] == 1)
+    assert 'HTTPError' in job_state(db, job_id)[2]
+
+    # Повтор отложен на 2 ** attempts секунд; сдвигаем срок, чтобы не ждать
+    with db.cursor() as cur:
+        cur.execute("UPDATE ai_jobs SET run_after = NOW() WHERE id = %s", (job_id,))
+    assert api.drain_ai_jobs()['done'] == 1
+
+    assert job_state(db, job_id)[:2] == ('done', 2)
+    assert ai_replies(db, chat_id) == ['Ответ: Повтори']
+    assert len(stub.requests) == 2
+
+def test_timeout_exhausts_attempts_with_error_reply(load_api, stub_ai, db, chat):
+    stub = stub_ai(delay=1.0)
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL=stub.url, AI_REQUEST_TIMEOUT=0.2)
+    chat_id, (user_id, _) = chat
+
+    status, data = send(api, chat_id, user_id, 'Долгий вопрос')
+    assert status == 200
+    job_id = data['ai_job_id']
+    assert wait_for(lambda: job_state(db, job_id)[1] == 1 and job_state(db, job_id)[0] == 'pending')
+    assert 'timed out' in job_state(db, job_id)[2]
+
+    with db.cursor() as cur:
+        cur.execute("UPDATE ai_jobs SET attempts = %s, run_after = NOW() WHERE id = %s", (api.AI_JOB_MAX_ATTEMPTS - 1, job_id))
+    assert api.drain_ai_jobs()['failed'] == 1
+
+    assert job_state(db, job_id)[0] == 'failed'
+    assert ai_replies(db, chat_id) == [api.AI_ERROR_REPLY]
+
+def test_poll_delivers_reply_without_background_worker(load_api, stub_ai, db, chat, monkeypatch):
+    stub = stub_ai(delay=0.1)
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL=stub.url)
+    # Среда заморозила процесс сразу после ответа: фоновый разбор так и не запустился
+    monkeypatch.setattr(api, 'start_ai_worker', lambda: None)
+    chat_id, (user_id, _) = chat
+
+    status, data = send(api, chat_id, user_id, 'Ты тут?')
+    assert status == 200
+    status, polled = invoke(api, 'GET', {'path': 'poll', 'chat_id': chat_id, 'after_id': data['message']['id'], 'timeout': 5},
+                            user_id=user_id)
+
+    assert status == 200
+    assert [(message['content'], message['is_ai']) for message in polled['messages']] == [('Ответ: Ты тут?', True)]
+    assert job_state(db, data['ai_job_id'])[:2] == ('done', 1)
+
+def test_running_job_is_not_reclaimed_with_short_timeout(load_api, db, chat, monkeypatch):
+    api = load_api(OPENAI_API_KEY='test', OPENAI_API_URL='http://127.0.0.1:9/', AI_REQUEST_TIMEOUT=0.2)
+    monkeypatch.setattr(api, 'start_ai_worker', lambda: None)
+    chat_id, (user_id, _) = chat
+    job_id = send(api, chat_id, user_id, 'Вопрос')[1]['ai_job_id']
+
+    conn, schema = api.get_db_connection()
+    try:
+        assert [job['id'] for job in api.claim_ai_jobs(conn, schema, 10, chat_id)] == [job_id]
+        assert api.claim_ai_jobs(conn, schema, 10, chat_id) == []
+    finally:
+        api.release_db_connection(conn)
@@ -0,0 +1,34 @@
+'''
+Пакетные запросы (action batch): каждый элемент получает свой статус, ошибка одного не роняет пакет.
+'''
+from harness import invoke
+
+def batch(api, requests, user_id=None):
+    status, data = invoke(api, 'POST', body={'action': 'batch', 'requests': requests}, user_id=user_id)
+    assert status == 200, data
+    return [(result['statusCode'], result['body']) for result in data['results']]
+
+def test_malformed_items_get_400(load_api, chat):
+    api = load_api()
+    chat_id, (user_id, _) = chat
+    results = batch(api, [
+        'chats',
+        None,
+        {'method': 7},
+        {'params': ['path', 'chats']},
+        {'method': 'POST', 'body': 'send_message'},
+        {'params': {'path': 'chats'}},
+    ], user_id=user_id)
+
+    assert [status for status, _ in results] == [400, 400, 400, 400, 400, 200]
+    assert [chat['id'] for chat in results[-1][1]['chats']] == [chat_id]
+
+def test_non_json_and_long_poll_paths_are_excluded(load_api, chat):
+    api = load_api()
+    chat_id, (user_id, _) = chat
+    results = batch(api, [
+        {'params': {'path': 'metrics'}},
+        {'params': {'path': 'poll', 'chat_id': chat_id, 'after_id': 0}},
+    ], user_id=user_id)
+
+    assert results == [(400, {'error': 'Request is not allowed in batch'})] * 2
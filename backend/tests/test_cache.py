@@ -0,0 +1,95 @@
+'''
+ReadThroughCache с общим backend: LocalCacheBackend вместо Redis, два кэша изображают два экземпляра функции.
+'''
+import time
+
+import pytest
+
+from harness import load_function
+
+@pytest.fixture
+def api(monkeypatch):
+    module = load_function('api')
+    monkeypatch.setattr(module, 'shared_cache_backend', module.LocalCacheBackend())
+    return module
+
+class Loader:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def __call__(self, keys):
+        self.calls.append(list(keys))
+        return {key: self.rows[key] for key in keys if key in self.rows}
+
+def test_instances_share_loaded_values(api):
+    first = api.ReadThroughCache('profile', 100, 60)
+    second = api.ReadThroughCache('profile', 100, 60)
+    loader = Loader({1: {'name': 'Анна'}, 2: {'name': 'Борис'}})
+
+    assert first.get_many([1, 2], loader) == {1: {'name': 'Анна'}, 2: {'name': 'Борис'}}
+    assert second.get_many([2, 1], loader) == {1: {'name': 'Анна'}, 2: {'name': 'Борис'}}
+
+    assert loader.calls == [[1, 2]]
+    assert second.stats == {'hits': 0, 'shared_hits': 2, 'misses': 0}
+    assert second.get(1, lambda key: None) == {'name': 'Анна'}
+    assert second.stats['hits'] == 1
+
+def test_invalidation_clears_shared_entry(api):
+    first = api.ReadThroughCache('profile', 100, 60)
+    second = api.ReadThroughCache('profile', 100, 60)
+    loader = Loader({1: {'name': 'Анна'}})
+    first.get_many([1], loader)
+    second.get_many([1], loader)
+
+    loader.rows[1] = {'name': 'Анна К.'}
+    second.invalidate([1])
+
+    # Старое значение ушло из общего кэша; локальный LRU первого экземпляра доживает до своего TTL
+    third = api.ReadThroughCache('profile', 100, 60)
+    assert second.get_many([1], loader) == {1: {'name': 'Анна К.'}}
+    assert third.get_many([1], loader) == {1: {'name': 'Анна К.'}}
+    assert first.get_many([1], loader) == {1: {'name': 'Анна'}}
+    assert len(loader.calls) == 2
+
+def test_namespaces_do_not_collide(api):
+    profiles = api.ReadThroughCache('profile', 100, 60)
+    phones = api.ReadThroughCache('phone', 100, 60)
+    profiles.get_many([1], Loader({1: {'name': 'Анна'}}))
+
+    assert phones.get_many([1], Loader({1: {'id': 7}})) == {1: {'id': 7}}
+
+def test_shared_entries_expire(api):
+    first = api.ReadThroughCache('membership', 100, 0.05)
+    second = api.ReadThroughCache('membership', 100, 0.05)
+    loader = Loader({5: [1, 2, 3]})
+    first.get_many([5], loader)
+    time.sleep(0.1)
+
+    assert second.get_many([5], loader) == {5: [1, 2, 3]}
+    assert second.stats['shared_hits'] == 0
+    assert len(loader.calls) == 2
+
+def test_backend_errors_fall_back_to_loader(api, monkeypatch):
+    class BrokenBackend(api.SharedCacheBackend):
+        '''
+        Redis недоступен: каждый вызов падает, как redis-py при отказе соединения.
+        '''
+        def get(self, key):
+            raise ConnectionError('Redis is unavailable')
+
+        def set(self, key, value, ttl_seconds):
+            raise ConnectionError('Redis is unavailable')
+
+        def delete(self, keys):
+            raise ConnectionError('Redis is unavailable')
+    with pytest.raises(TypeError):
+        api.SharedCacheBackend()
+    monkeypatch.setattr(api, 'shared_cache_backend', BrokenBackend())
+    cache = api.ReadThroughCache('profile', 100, 60)
+    loader = Loader({1: {'name': 'Анна'}})
+
+    assert cache.get_many([1], loader) == {1: {'name': 'Анна'}}
+    cache.invalidate([1])
+    assert cache.get_many([1], loader) == {1: {'name': 'Анна'}}
+    assert len(loader.calls) == 2
@@ -0,0 +1,53 @@
+'''
+Контакты (GET ?path=contacts): страницы по курсору и дельта по токену из xmin снимка.
+'''
+import psycopg2
+
+from harness import invoke, seed_users
+
+def contacts(api, user_id: int, **params):
+    status, data = invoke(api, 'GET', {'path': 'contacts', **params}, user_id=user_id)
+    assert status == 200, data
+    return data
+
+def test_delta_returns_changed_contacts_once(load_api, db):
+    api = load_api()
+    owner, anna, boris = seed_users(db, 3, prefix='+79520')
+    for contact in (anna, boris):
+        invoke(api, 'POST', body={'action': 'add_contact', 'user_id': owner, 'contact_user_id': contact})
+
+    first = contacts(api, owner, limit=1)
+    assert first['sync_token'] and first['next_cursor']
+    assert contacts(api, owner, limit=1, cursor=first['next_cursor'])['sync_token'] is None
+    assert contacts(api, owner, token=first['sync_token'])['contacts'] == []
+
+    with db.cursor() as cur:
+        cur.execute("SELECT phone FROM users WHERE id = %s", (anna,))
+        phone = cur.fetchone()[0]
+    invoke(api, 'POST', body={'action': 'register', 'phone': phone, 'name': 'Анна'})
+
+    delta = contacts(api, owner, token=first['sync_token'])
+    assert [(row['id'], row['name']) for row in delta['contacts']] == [(anna, 'Анна')]
+    assert contacts(api, owner, token=delta['sync_token'])['contacts'] == []
+
+def test_change_committed_after_token_is_not_lost(load_api, db, database_url):
+    api = load_api()
+    owner, contact = seed_users(db, 2, prefix='+79521')
+
+    # Транзакция начата до выдачи токена, а закоммичена после
+    writer = psycopg2.connect(database_url)
+    try:
+        with writer.cursor() as cur:
+            cur.execute("INSERT INTO contacts (user_id, contact_user_id) VALUES (%s, %s)", (owner, contact))
+        token = contacts(api, owner)['sync_token']
+        writer.commit()
+    finally:
+        writer.close()
+
+    assert [row['id'] for row in contacts(api, owner, token=token)['contacts']] == [contact]
+
+def test_invalid_token_is_rejected(load_api, db):
+    api = load_api()
+    owner, = seed_users(db, 1, prefix='+79522')
+    status, _ = invoke(api, 'GET', {'path': 'contacts', 'token': 'not-a-token'}, user_id=owner)
+    assert status == 400
@@ -0,0 +1,32 @@
+'''
+Импорт истории (action import_messages) в чаты, созданные разными путями.
+'''
+import json
+
+from harness import invoke, seed_users
+
+def test_import_into_group_chat(load_api, db):
+    api = load_api()
+    owner, member, outsider = seed_users(db, 3, prefix='+79510')
+    status, group = invoke(api, 'POST', body={
+        'action': 'create_group', 'name': 'Архив', 'created_by': owner, 'member_ids': [member]
+    }, user_id=owner)
+    assert status == 200
+    data = '\n'.join(json.dumps(record) for record in [
+        {'sender_id': owner, 'content': 'Было', 'created_at': '2024-03-01T10:00:00'},
+        {'sender_id': member, 'content': 'Помню', 'created_at': '2024-03-01T10:05:00'},
+    ])
+
+    status, result = invoke(api, 'POST', body={
+        'action': 'import_messages', 'chat_id': group['chat_id'], 'data': data
+    }, user_id=member)
+    assert status == 200, result
+    assert result['imported'] == 2
+
+    status, chats = invoke(api, 'GET', {'path': 'chats'}, user_id=owner)
+    assert [(row['last_message'], row['unread']) for row in chats['chats'] if row['id'] == group['chat_id']] == [('Помню', 0)]
+
+    status, result = invoke(api, 'POST', body={
+        'action': 'import_messages', 'chat_id': group['chat_id'], 'data': data
+    }, user_id=outsider)
+    assert status == 403
@@ -0,0 +1,19 @@
+'''
+Отправка сообщений (action send_message): неполный запрос отклоняется до записи.
+'''
+import pytest
+
+from harness import invoke
+
+@pytest.mark.parametrize('missing', ['chat_id', 'sender_id', 'content'])
+def test_send_message_requires_fields(load_api, chat, db, missing):
+    api = load_api()
+    chat_id, (sender_id, _) = chat
+    body = {'action': 'send_message', 'chat_id': chat_id, 'sender_id': sender_id, 'content': 'Привет'}
+    del body[missing]
+
+    status, data = invoke(api, 'POST', body=body, user_id=sender_id)
+    assert status == 400, data
+    with db.cursor() as cur:
+        cur.execute("SELECT count(*) FROM messages WHERE chat_id = %s", (chat_id,))
+        assert cur.fetchone()[0] == 0
@@ -0,0 +1,52 @@
+'''
+Непрочитанные: позиция прочтения сдвигается, когда участник получает свежие сообщения через messages или poll.
+'''
+from harness import invoke
+
+def send(api, chat_id: int, sender_id: int, content: str) -> int:
+    status, data = invoke(api, 'POST', body={
+        'action': 'send_message', 'chat_id': chat_id, 'sender_id': sender_id, 'content': content
+    }, user_id=sender_id)
+    assert status == 200, data
+    return data['message']['id']
+
+def unread(api, chat_id: int, user_id: int) -> int:
+    status, data = invoke(api, 'GET', {'path': 'chats'}, user_id=user_id)
+    assert status == 200, data
+    return next(row['unread'] for row in data['chats'] if row['id'] == chat_id)
+
+def test_newest_page_marks_chat_read(load_api, chat):
+    api = load_api()
+    chat_id, (author, reader) = chat
+    first = send(api, chat_id, author, 'Первое')
+    send(api, chat_id, author, 'Второе')
+    assert unread(api, chat_id, reader) == 2
+
+    # Более старая страница не означает, что прочитаны новые сообщения
+    status, _ = invoke(api, 'GET', {'path': 'messages', 'chat_id': chat_id, 'before_id': first}, user_id=reader)
+    assert status == 200
+    assert unread(api, chat_id, reader) == 2
+
+    status, page = invoke(api, 'GET', {'path': 'messages', 'chat_id': chat_id}, user_id=reader)
+    assert status == 200 and len(page['messages']) == 2
+    assert unread(api, chat_id, reader) == 0
+    assert unread(api, chat_id, author) == 0
+
+def test_poll_marks_delivered_messages_read(load_api, chat):
+    api = load_api()
+    chat_id, (author, reader) = chat
+    last = send(api, chat_id, author, 'Привет')
+    invoke(api, 'GET', {'path': 'messages', 'chat_id': chat_id}, user_id=reader)
+
+    send(api, chat_id, author, 'Как дела?')
+    assert unread(api, chat_id, reader) == 1
+
+    status, data = invoke(api, 'GET', {'path': 'poll', 'chat_id': chat_id, 'after_id': last, 'timeout': 1}, user_id=reader)
+    assert status == 200 and [m['content'] for m in data['messages']] == ['Как дела?']
+    assert unread(api, chat_id, reader) == 0
+
+    # Без X-User-Id poll ничего не отмечает
+    newest = send(api, chat_id, author, 'Ау')
+    status, data = invoke(api, 'GET', {'path': 'poll', 'chat_id': chat_id, 'after_id': data['cursor'], 'timeout': 1})
+    assert status == 200 and data['cursor'] == newest
+    assert unread(api, chat_id, reader) == 1
@@ -0,0 +1,82 @@
+'''
+Поиск по сообщениям: результаты только из чатов пользователя, порядок по рангу и страницы по курсору.
+Задержку здесь не проверяем — её замеряет backend/bench/bench_search.py (--max-p95-ms).
+'''
+import os
+import random
+
+import psycopg2
+import pytest
+
+from bench_search import load_members, search, seed_corpus
+from harness import create_database, invoke, load_function
+
+CORPUS_MESSAGES = int(os.environ.get('TEST_SEARCH_MESSAGES', '20000'))
+RARE_TOKENS = CORPUS_MESSAGES // 30
+
+@pytest.fixture(scope='module')
+def corpus(admin_database_url):
+    url = create_database(admin_database_url, 'chattix_test_search')
+    seed_corpus(url, users=200, chat_sizes=[10] * 100, messages=CORPUS_MESSAGES, rare_tokens=RARE_TOKENS)
+    return url, load_members(url)
+
+@pytest.fixture
+def search_api(corpus, monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', corpus[0])
+    return load_function('api')
+
+def expected_ids(url: str, chat_ids, q: str):
+    conn = psycopg2.connect(url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH q AS (SELECT websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s) AS query)
+                SELECT m.id FROM messages m, q
+                WHERE m.search_vector @@ q.query AND m.chat_id = ANY(%s)
+                ORDER BY ts_rank(m.search_vector, q.query)::float8 DESC, m.id DESC
+            """, (q, q, list(chat_ids)))
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+def test_results_come_only_from_user_chats(corpus, search_api):
+    url, members = corpus
+    rng = random.Random(1)
+    for chat_id in rng.sample(list(members), 5):
+        user_id = members[chat_id][0]
+        user_chats = {c for c, user_ids in members.items() if user_id in user_ids}
+        results = search(search_api, user_id, 'привет')['results']
+        assert results
+        assert {result['chat_id'] for result in results} <= user_chats
+        ranks = [(result['rank'], result['id']) for result in results]
+        assert ranks == sorted(ranks, reverse=True)
+
+@pytest.mark.parametrize('q', ['привет', 'привет tag1', 'кофе OR обед'])
+def test_cursor_pages_have_no_duplicates_or_gaps(corpus, search_api, q):
+    url, members = corpus
+    user_id = members[next(iter(members))][0]
+    user_chats = {c for c, user_ids in members.items() if user_id in user_ids}
+
+    ids, cursor, pages = [], None, 0
+    while True:
+        params = {'path': 'search_messages', 'q': q, 'limit': 7}
+        if cursor:
+            params['cursor'] = cursor
+        status, data = invoke(search_api, 'GET', params, user_id=user_id)
+        assert status == 200, data
+        assert len(data['results']) <= 7
+        ids += [result['id'] for result in data['results']]
+        pages += 1
+        cursor = data['next_cursor']
+        if not cursor:
+            break
+
+    assert ids == expected_ids(url, user_chats, q)
+    assert len(ids) == len(set(ids))
+    if q == 'привет':
+        assert pages > 2
+
+def test_invalid_cursor_is_rejected(corpus, search_api):
+    user_id = next(iter(corpus[1].values()))[0]
+    status, _ = invoke(search_api, 'GET', {'path': 'search_messages', 'q': 'привет', 'cursor': 'garbage'}, user_id=user_id)
+    assert status == 400
@@ -0,0 +1,40 @@
+'''
+Дельта-синхронизация (GET ?path=sync) при нескольких тёплых экземплярах функции.
+'''
+from harness import invoke, seed_users
+
+def sync(api, user_id: int, token: str = None):
+    params = {'path': 'sync'}
+    if token:
+        params['token'] = token
+    status, data = invoke(api, 'GET', params, user_id=user_id)
+    assert status == 200, data
+    return data
+
+def test_group_created_on_another_instance_is_synced(load_api, db):
+    first, second = load_api(), load_api()
+    owner, member = seed_users(db, 2, prefix='+79500')
+
+    # Первый экземпляр кэширует членство участника, пока групп у него нет
+    token = sync(first, member)['sync_token']
+    assert invoke(first, 'GET', {'path': 'chats'}, user_id=member) == (200, {'chats': []})
+
+    status, group = invoke(second, 'POST', body={
+        'action': 'create_group', 'name': 'Команда', 'created_by': owner, 'member_ids': [member]
+    }, user_id=owner)
+    assert status == 200
+    status, sent = invoke(second, 'POST', body={
+        'action': 'send_message', 'chat_id': group['chat_id'], 'sender_id': owner, 'content': 'Всем привет'
+    }, user_id=owner)
+    assert status == 200
+
+    changes = sync(first, member, token)
+    assert [message['id'] for message in changes['messages']] == [sent['message']['id']]
+    assert [(chat['id'], chat['name'], chat['is_group'], chat['unread']) for chat in changes['chats']] == [
+        (group['chat_id'], 'Команда', True, 1)
+    ]
+    assert {(row['chat_id'], row['user_id']) for row in changes['members']} == {(group['chat_id'], owner)}
+
+    # Следующая синхронизация ничего не повторяет
+    again = sync(first, member, changes['sync_token'])
+    assert again['messages'] == [] and again['chats'] == []
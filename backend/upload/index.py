@@ -1,13 +1,340 @@
+import io
 import json
 import os
 import base64
+import hashlib
+import hmac
+import logging
+import sys
+import time
 import uuid
-from typing import Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+import psycopg2
+from PIL import Image, ImageOps
+from typing import Dict, Any, Optional
+
+UPLOAD_DIR = '/tmp/uploads'
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, '.partial')
+BLOB_DIR = os.path.join(UPLOAD_DIR, 'blobs')
+BLOB_URL_PREFIX = 'https://storage.example.com/chattik/blobs/'
+BLOB_GC_GRACE_SECONDS = 24 * 3600
+BLOB_GC_BATCH_SIZE = 500
+# Секрет для action gc (заголовок X-Maintenance-Token); без него сборка мусора выключена
+BLOB_GC_TOKEN = os.environ.get('BLOB_GC_TOKEN')
+THUMBNAIL_SIZES = (64, 320, 800)
+PLACEHOLDER_SIZE = 16
+PREVIEW_WORKERS = 2
+Image.MAX_IMAGE_PIXELS = 40_000_000
+MAX_FILE_SIZE = 10 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 2 * CHUNK_SIZE
+HASH_BLOCK_SIZE = 256 * 1024
+PARTIAL_TTL_SECONDS = 24 * 3600
+
+logger = logging.getLogger('chattix.upload')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+def json_response(status_code: int, data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status_code,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(data),
+        'isBase64Encoded': False
+    }
+
+def current_schema(cur) -> str:
+    cur.execute("SELECT current_schema()")
+    return cur.fetchone()[0]
+
+def blob_relative_path(sha256: str) -> str:
+    return f"{sha256[:2]}/{sha256[2:4]}/{sha256}"
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, blob_relative_path(sha256))
+
+def blob_url(sha256: str) -> str:
+    return f"{BLOB_URL_PREFIX}{blob_relative_path(sha256)}"
+
+def is_sha256(value: Any) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+def store_blob(tmp_path: str, sha256: str) -> None:
+    '''
+    Кладёт файл в хранилище по его SHA-256. Если такой blob уже есть, временный файл просто удаляется,
+    а mtime blob обновляется, чтобы сборщик мусора не удалил его до привязки к сообщению.
+    '''
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        os.utime(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+
+def partial_paths(upload_id: str) -> tuple:
+    if not upload_id or not all(c in '0123456789abcdef-' for c in upload_id):
+        raise ValueError('Invalid upload_id')
+    return os.path.join(PARTIAL_DIR, f"{upload_id}.json"), os.path.join(PARTIAL_DIR, f"{upload_id}.part")
+
+def load_upload_meta(upload_id: str) -> Optional[Dict[str, Any]]:
+    meta_path, _ = partial_paths(upload_id)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cleanup_stale_partials() -> None:
+    cutoff = time.time() - PARTIAL_TTL_SECONDS
+    for entry in os.scandir(PARTIAL_DIR):
+        # Параллельный finalize мог уже перенести .part в хранилище и удалить .json
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+
+def init_upload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    file_name = body_data.get('name', 'file')
+    file_type = body_data.get('type', 'application/octet-stream')
+    file_size = body_data.get('size')
+
+    if not isinstance(file_size, int) or file_size <= 0:
+        return json_response(400, {'error': 'File size is required'})
+    if file_size > MAX_FILE_SIZE:
+        return json_response(400, {'error': 'File too large. Max 10MB'})
+
+    sha256 = (body_data.get('sha256') or '').lower()
+    if is_sha256(sha256) and os.path.exists(blob_path(sha256)) and os.path.getsize(blob_path(sha256)) == file_size:
+        os.utime(blob_path(sha256))
+        return json_response(200, {
+            'url': blob_url(sha256),
+            'name': file_name,
+            'type': file_type,
+            'size': file_size,
+            'sha256': sha256,
+            'exists': True
+        })
+
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    cleanup_stale_partials()
+
+    upload_id = str(uuid.uuid4())
+    meta_path, part_path = partial_paths(upload_id)
+    with open(meta_path, 'w') as f:
+        json.dump({'name': file_name, 'type': file_type, 'size': file_size, 'sha256': body_data.get('sha256')}, f)
+    open(part_path, 'wb').close()
+
+    return json_response(200, {'upload_id': upload_id, 'chunk_size': CHUNK_SIZE, 'received': 0})
+
+def append_chunk(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id', '')
+    meta = load_upload_meta(upload_id)
+    if meta is None:
+        return json_response(404, {'error': 'Upload not found'})
+
+    _, part_path = partial_paths(upload_id)
+    received = os.path.getsize(part_path)
+    offset = body_data.get('offset')
+    if offset != received:
+        return json_response(409, {'error': 'Offset mismatch', 'received': received})
+
+    chunk_data = body_data.get('chunk') or ''
+    if len(chunk_data) > MAX_CHUNK_SIZE * 4 // 3 + 4:
+        return json_response(400, {'error': 'Chunk too large'})
+    chunk = base64.b64decode(chunk_data)
+    if received + len(chunk) > meta['size']:
+        return json_response(400, {'error': 'Chunk exceeds declared file size'})
+
+    with open(part_path, 'ab') as f:
+        f.write(chunk)
+
+    return json_response(200, {'upload_id': upload_id, 'received': received + len(chunk)})
+
+def upload_status(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id', '')
+    meta = load_upload_meta(upload_id)
+    if meta is None:
+        return json_response(404, {'error': 'Upload not found'})
+
+    _, part_path = partial_paths(upload_id)
+    return json_response(200, {'upload_id': upload_id, 'received': os.path.getsize(part_path), 'size': meta['size']})
+
+def finalize_upload(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id', '')
+    meta = load_upload_meta(upload_id)
+    if meta is None:
+        return json_response(404, {'error': 'Upload not found'})
+
+    meta_path, part_path = partial_paths(upload_id)
+    received = os.path.getsize(part_path)
+    if received != meta['size']:
+        return json_response(409, {'error': 'Upload incomplete', 'received': received})
+
+    expected_hash = body_data.get('sha256') or meta.get('sha256')
+    actual_hash = sha256_file(part_path)
+    if expected_hash and expected_hash.lower() != actual_hash:
+        return json_response(422, {'error': 'Checksum mismatch'})
+
+    store_blob(part_path, actual_hash)
+    os.remove(meta_path)
+    previews_pending = schedule_previews(actual_hash, meta['type'])
+
+    return json_response(200, {
+        'url': blob_url(actual_hash),
+        'name': meta['name'],
+        'type': meta['type'],
+        'size': received,
+        'sha256': actual_hash,
+        'previews_pending': previews_pending
+    })
+
+def preview_paths(sha256: str) -> Dict[int, str]:
+    return {size: f"{blob_path(sha256)}.thumb{size}.jpg" for size in THUMBNAIL_SIZES}
+
+def generate_previews(sha256: str) -> Dict[str, Any]:
+    '''
+    Делает уменьшенные копии изображения рядом с оригиналом и крошечный размытый placeholder (data URL),
+    затем записывает их в attachment_previews по URL вложения. Выполняется в пуле процессов.
+    '''
+    thumbnails: Dict[str, str] = {}
+    with Image.open(blob_path(sha256)) as image:
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) >= 5:
+            width, height = height, width
+        image.draft('RGB', (max(THUMBNAIL_SIZES), max(THUMBNAIL_SIZES)))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        
+        for size, path in preview_paths(sha256).items():
+            if max(width, height) <= size:
+                break
+            thumb = image.copy()
+            thumb.thumbnail((size, size))
+            thumb.save(path, 'JPEG', quality=80, optimize=True)
+            thumbnails[str(size)] = f"{blob_url(sha256)}.thumb{size}.jpg"
+        
+        tiny = image.copy()
+        tiny.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+        buffer = io.BytesIO()
+        tiny.save(buffer, 'JPEG', quality=40)
+        placeholder = 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+    
+    preview = {'thumbnails': thumbnails, 'placeholder': placeholder, 'width': width, 'height': height}
+    
+    if os.environ.get('DATABASE_URL'):
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            with conn.cursor() as cur:
+                schema = current_schema(cur)
+                cur.execute(f"""
+                    INSERT INTO {schema}.attachment_previews (attachment_url, thumbnails, placeholder, width, height)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (attachment_url) DO UPDATE SET
+                        thumbnails = EXCLUDED.thumbnails, placeholder = EXCLUDED.placeholder,
+                        width = EXCLUDED.width, height = EXCLUDED.height
+                """, (blob_url(sha256), json.dumps(thumbnails), placeholder, width, height))
+            conn.commit()
+        finally:
+            conn.close()
+    return preview
+
+_preview_pool: Optional[ProcessPoolExecutor] = None
+
+def schedule_previews(sha256: str, file_type: str) -> bool:
+    '''
+    Ставит генерацию превью в ограниченный пул процессов, не задерживая ответ на загрузку.
+    '''
+    global _preview_pool
+    if not (file_type or '').startswith('image/'):
+        return False
+    if _preview_pool is None:
+        _preview_pool = ProcessPoolExecutor(max_workers=PREVIEW_WORKERS)
+    future = _preview_pool.submit(generate_previews, sha256)
+    future.add_done_callback(lambda done: log_preview_failure(done, sha256))
+    return True
+
+def log_preview_failure(future, sha256: str) -> None:
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        logger.error(f'Preview generation failed for {sha256}', exc_info=error)
+
+def collect_garbage(body_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Сборка мусора обходом (mark-and-sweep) вместо счётчиков ссылок: удаляет blob, на которые не ссылается
+    ни одно messages.attachment_url и которых нет в archived_attachments (вложения архивированных секций).
+    Свежие blob (моложе BLOB_GC_GRACE_SECONDS) не трогаем: их могли загрузить, но ещё не отправить.
+    Перед удалением mtime проверяется повторно — init мог переиспользовать blob во время прохода.
+    '''
+    cutoff = time.time() - BLOB_GC_GRACE_SECONDS
+    candidates: Dict[str, tuple] = {}
+    for root, _, files in os.walk(BLOB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            if is_sha256(name) and stat.st_mtime < cutoff:
+                candidates[blob_url(name)] = (path, stat.st_size)
+
+    stats = {'scanned': len(candidates), 'deleted': 0, 'freed_bytes': 0}
+    if not candidates:
+        return json_response(200, stats)
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        urls = list(candidates)
+        referenced = set()
+        with conn.cursor() as cur:
+            schema = current_schema(cur)
+            for i in range(0, len(urls), BLOB_GC_BATCH_SIZE):
+                cur.execute(f"""
+                    SELECT attachment_url FROM {schema}.messages WHERE attachment_url = ANY(%s)
+                    UNION
+                    SELECT attachment_url FROM {schema}.archived_attachments WHERE attachment_url = ANY(%s)
+                """, (urls[i:i + BLOB_GC_BATCH_SIZE], urls[i:i + BLOB_GC_BATCH_SIZE]))
+                referenced.update(row[0] for row in cur.fetchall())
+
+        deleted_urls = []
+        for url, (path, _) in candidates.items():
+            if url in referenced:
+                continue
+            # init с тем же sha256 мог переиспользовать blob уже после сканирования — тогда mtime свежий
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            for preview_path in [path] + list(preview_paths(os.path.basename(path)).values()):
+                if os.path.exists(preview_path):
+                    stats['freed_bytes'] += os.path.getsize(preview_path)
+                    os.remove(preview_path)
+            stats['deleted'] += 1
+            deleted_urls.append(url)
+
+        with conn.cursor() as cur:
+            cur.execute(f"DELETE FROM {schema}.attachment_previews WHERE attachment_url = ANY(%s)", (deleted_urls,))
+        conn.commit()
+    finally:
+        conn.close()
+
+    return json_response(200, stats)
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Загрузка файлов и изображений для чата
-    Args: event с httpMethod, body содержащим base64 файл
+    Args: event с httpMethod, body содержащим base64 файл целиком
+          или action init / append / status / finalize для загрузки по частям
     Returns: URL загруженного файла
     '''
     method: str = event.get('httpMethod', 'GET')
@@ -34,6 +361,30 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     body_data = json.loads(event.get('body', '{}'))
+    action = body_data.get('action')
+    
+    if action == 'gc':
+        headers = event.get('headers') or {}
+        token = headers.get('x-maintenance-token') or headers.get('X-Maintenance-Token') or ''
+        if not BLOB_GC_TOKEN or not hmac.compare_digest(token.encode('utf-8'), BLOB_GC_TOKEN.encode('utf-8')):
+            return json_response(403, {'error': 'Forbidden'})
+    
+    try:
+        if action == 'init':
+            return init_upload(body_data)
+        elif action == 'append':
+            return append_chunk(body_data)
+        elif action == 'status':
+            return upload_status(body_data)
+        elif action == 'finalize':
+            return finalize_upload(body_data)
+        elif action == 'gc':
+            return collect_garbage(body_data)
+    except ValueError as e:
+        return json_response(400, {'error': str(e)})
+    except Exception as e:
+        return json_response(500, {'error': f'Upload failed: {str(e)}'})
+    
     file_data = body_data.get('file')
     file_name = body_data.get('name', 'file')
     file_type = body_data.get('type', 'application/octet-stream')
@@ -47,10 +398,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     try:
-        file_bytes = base64.b64decode(file_data.split(',')[1] if ',' in file_data else file_data)
-        file_size = len(file_bytes)
-        
-        if file_size > 10 * 1024 * 1024:
+        encoded = file_data.split(',')[1] if ',' in file_data else file_data
+        if len(encoded) * 3 // 4 > MAX_FILE_SIZE + 2:
             return {
                 'statusCode': 400,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -58,27 +407,37 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'isBase64Encoded': False
             }
         
-        file_id = str(uuid.uuid4())
-        file_ext = file_name.split('.')[-1] if '.' in file_name else 'bin'
-        stored_name = f"{file_id}.{file_ext}"
-        
-        upload_dir = '/tmp/uploads'
-        os.makedirs(upload_dir, exist_ok=True)
-        file_path = os.path.join(upload_dir, stored_name)
+        file_bytes = base64.b64decode(encoded)
+        file_size = len(file_bytes)
         
-        with open(file_path, 'wb') as f:
-            f.write(file_bytes)
+        if file_size > MAX_FILE_SIZE:
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'error': 'File too large. Max 10MB'}),
+                'isBase64Encoded': False
+            }
         
-        file_url = f"https://storage.example.com/chattik/{stored_name}"
+        sha256 = hashlib.sha256(file_bytes).hexdigest()
+        if not os.path.exists(blob_path(sha256)):
+            os.makedirs(PARTIAL_DIR, exist_ok=True)
+            tmp_path = os.path.join(PARTIAL_DIR, f"{uuid.uuid4()}.part")
+            with open(tmp_path, 'wb') as f:
+                f.write(file_bytes)
+            store_blob(tmp_path, sha256)
+            schedule_previews(sha256, file_type)
+        else:
+            os.utime(blob_path(sha256))
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
-                'url': file_url,
+                'url': blob_url(sha256),
                 'name': file_name,
                 'type': file_type,
-                'size': file_size
+                'size': file_size,
+                'sha256': sha256
             }),
             'isBase64Encoded': False
         }
@@ -0,0 +1,5 @@
+-- Индекс для постраничной выдачи сообщений чата по курсору (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at DESC, id DESC);
+
+-- Старый индекс покрывается новым: (chat_id, created_at DESC) является его префиксом
+DROP INDEX IF EXISTS idx_messages_chat;
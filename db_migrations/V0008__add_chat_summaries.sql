@@ -0,0 +1,26 @@
+-- Сводка по чату: последнее сообщение и общее число сообщений, обновляется вместе с вставкой сообщения
+CREATE TABLE IF NOT EXISTS chat_summaries (
+    chat_id INTEGER PRIMARY KEY,
+    last_message_id INTEGER,
+    last_message_content TEXT,
+    last_message_at TIMESTAMP,
+    message_count INTEGER NOT NULL DEFAULT 0
+);
+
+-- Позиция прочтения участника: непрочитанные = message_count - last_read_count
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_message_id INTEGER;
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS last_read_count INTEGER NOT NULL DEFAULT 0;
+
+-- Заполняем сводки по уже существующим сообщениям
+INSERT INTO chat_summaries (chat_id, last_message_id, last_message_content, last_message_at, message_count)
+SELECT DISTINCT ON (chat_id) chat_id, id, content, created_at, COUNT(*) OVER (PARTITION BY chat_id)
+FROM messages
+WHERE chat_id IS NOT NULL
+ORDER BY chat_id, created_at DESC, id DESC
+ON CONFLICT (chat_id) DO NOTHING;
+
+-- Существующая история считается прочитанной
+UPDATE chat_members cm
+SET last_read_message_id = s.last_message_id, last_read_count = s.message_count
+FROM chat_summaries s
+WHERE s.chat_id = cm.chat_id;
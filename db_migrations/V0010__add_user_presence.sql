@@ -0,0 +1,9 @@
+-- Присутствие пользователей: частые heartbeat пишутся сюда, а не в users.
+-- UNLOGGED — без записи в WAL; при сбое таблица очищается, и статус берётся из users.
+-- fillfactor и отсутствие вторичных индексов оставляют обновления HOT.
+CREATE UNLOGGED TABLE IF NOT EXISTS user_presence (
+    user_id INTEGER PRIMARY KEY,
+    is_online BOOLEAN NOT NULL DEFAULT false,
+    last_heartbeat TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    dirty BOOLEAN NOT NULL DEFAULT true
+) WITH (fillfactor = 70);
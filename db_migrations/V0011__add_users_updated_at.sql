@@ -0,0 +1,2 @@
+-- Время последнего изменения профиля — для инкрементальной синхронизации контактов (updated_since)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,9 @@
+-- Превью изображений-вложений: уменьшенные копии и размытый placeholder по URL вложения (messages.attachment_url)
+CREATE TABLE IF NOT EXISTS attachment_previews (
+    attachment_url TEXT PRIMARY KEY,
+    thumbnails JSONB NOT NULL DEFAULT '{}',
+    placeholder TEXT,
+    width INTEGER,
+    height INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
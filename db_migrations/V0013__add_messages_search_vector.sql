@@ -0,0 +1,7 @@
+-- Полнотекстовый поиск по сообщениям: русская и английская конфигурации, столбец поддерживается самой БД
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('russian', COALESCE(content, '')) || to_tsvector('english', COALESCE(content, ''))
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING GIN (search_vector);
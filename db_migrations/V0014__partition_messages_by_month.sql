@@ -0,0 +1,116 @@
+-- Секционирование messages по месяцам (created_at). Старые секции можно отсоединять и архивировать.
+
+ALTER TABLE messages RENAME TO messages_legacy;
+ALTER SEQUENCE messages_id_seq OWNED BY NONE;
+ALTER SEQUENCE messages_id_seq AS BIGINT;
+
+UPDATE messages_legacy SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+
+-- Если messages создана ещё в V0001, колонок из V0003/V0005 в ней нет (там CREATE TABLE IF NOT EXISTS)
+ALTER TABLE messages_legacy ADD COLUMN IF NOT EXISTS type VARCHAR(20) DEFAULT 'text';
+ALTER TABLE messages_legacy ADD COLUMN IF NOT EXISTS is_ai BOOLEAN DEFAULT false;
+ALTER TABLE messages_legacy ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+CREATE TABLE messages (
+    id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+    chat_id INTEGER,
+    sender_id INTEGER,
+    content TEXT NOT NULL,
+    type VARCHAR(20) DEFAULT 'text',
+    is_ai BOOLEAN DEFAULT false,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    attachment_url TEXT,
+    attachment_type VARCHAR(50),
+    attachment_name TEXT,
+    attachment_size INTEGER,
+    search_vector tsvector GENERATED ALWAYS AS (
+        to_tsvector('russian', COALESCE(content, '')) || to_tsvector('english', COALESCE(content, ''))
+    ) STORED,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Сюда попадают строки вне созданных секций (например, импорт очень старой истории)
+CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;
+
+-- Создаёт недостающие месячные секции от from_month до текущего месяца + months_ahead.
+-- Строки этого месяца из DEFAULT-секции переносятся во вновь созданную секцию в той же транзакции,
+-- иначе CREATE TABLE ... PARTITION OF падает.
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(months_ahead INTEGER DEFAULT 3, from_month DATE DEFAULT CURRENT_DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_month)::date;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+    month_end DATE;
+    partition_name TEXT;
+    columns TEXT;
+    created INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := 'messages_y' || to_char(month_start, 'YYYY') || 'm' || to_char(month_start, 'MM');
+        month_end := (month_start + INTERVAL '1 month')::date;
+        IF to_regclass(partition_name) IS NULL THEN
+            LOCK TABLE messages_default IN EXCLUSIVE MODE;
+            IF EXISTS (SELECT 1 FROM messages_default WHERE created_at >= month_start AND created_at < month_end) THEN
+                SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum) INTO columns
+                FROM pg_attribute
+                WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = '';
+                
+                CREATE TEMP TABLE IF NOT EXISTS messages_moving (LIKE messages_default) ON COMMIT DROP;
+                TRUNCATE messages_moving;
+                INSERT INTO messages_moving
+                SELECT * FROM messages_default WHERE created_at >= month_start AND created_at < month_end;
+                DELETE FROM messages_default WHERE created_at >= month_start AND created_at < month_end;
+                
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_end
+                );
+                EXECUTE format('INSERT INTO messages (%s) SELECT %s FROM messages_moving', columns, columns);
+            ELSE
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, month_start, month_end
+                );
+            END IF;
+            created := created + 1;
+        END IF;
+        month_start := month_end;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_messages_partitions(3, COALESCE((SELECT MIN(created_at)::date FROM messages_legacy), CURRENT_DATE));
+
+INSERT INTO messages (id, chat_id, sender_id, content, type, is_ai, created_at, updated_at,
+                      attachment_url, attachment_type, attachment_name, attachment_size)
+SELECT id, chat_id, sender_id, content, type, is_ai, created_at, updated_at,
+       attachment_url, attachment_type, attachment_name, attachment_size
+FROM messages_legacy;
+
+DROP TABLE messages_legacy;
+
+-- Внешние ключи из V0001 (chat_id -> chats, sender_id -> users) пропали вместе с messages_legacy
+ALTER TABLE messages ADD CONSTRAINT messages_chat_id_fkey FOREIGN KEY (chat_id) REFERENCES chats(id);
+ALTER TABLE messages ADD CONSTRAINT messages_sender_id_fkey FOREIGN KEY (sender_id) REFERENCES users(id);
+
+-- id сообщений теперь BIGINT, ссылки на них тоже
+ALTER TABLE chat_summaries ALTER COLUMN last_message_id TYPE BIGINT;
+ALTER TABLE chat_members ALTER COLUMN last_read_message_id TYPE BIGINT;
+ALTER TABLE ai_jobs ALTER COLUMN message_id TYPE BIGINT;
+ALTER TABLE ai_jobs ALTER COLUMN reply_message_id TYPE BIGINT;
+
+-- Индексы создаются на родительской таблице и наследуются каждой секцией
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_id ON messages(chat_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_messages_with_attachments ON messages(attachment_url) WHERE attachment_url IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_search_vector ON messages USING GIN (search_vector);
+
+-- URL вложений из архивированных секций: сборщик мусора upload не удаляет эти blob
+CREATE TABLE IF NOT EXISTS archived_attachments (
+    attachment_url TEXT PRIMARY KEY,
+    partition_name TEXT NOT NULL,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
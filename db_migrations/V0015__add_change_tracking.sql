@@ -0,0 +1,22 @@
+-- Метка изменения для дельта-синхронизации (GET ?path=sync): xid8 транзакции, записавшей строку.
+-- pg_current_xact_id() растёт монотонно. Токен клиента — xmin снимка: все транзакции с меньшим xid
+-- уже завершены, поэтому строки из диапазона [старый токен, новый токен) отдаются ровно один раз.
+-- Существующие строки остаются с NULL — их клиент получает при полной загрузке.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE users ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+ALTER TABLE contacts ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE contacts ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+ALTER TABLE chat_members ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE chat_members ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+ALTER TABLE chat_summaries ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE chat_summaries ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE messages ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+-- Сообщения только вставляются, поэтому индекс не мешает HOT; users, chat_members и chat_summaries
+-- фильтруются по чатам/контактам пользователя и отдельного индекса по change_xid не требуют
+CREATE INDEX IF NOT EXISTS idx_messages_chat_change_xid ON messages(chat_id, change_xid);
@@ -0,0 +1,3 @@
+-- В базах, созданных с V0001, таблица chats уже существовала, и CREATE TABLE IF NOT EXISTS из V0005
+-- не добавил group_id, на которую ссылается create_group
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS group_id INTEGER;
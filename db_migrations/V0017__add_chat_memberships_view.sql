@@ -0,0 +1,21 @@
+-- Участники групп, созданных через create_group, записаны в chat_participants, а не в chat_members.
+-- Даём им ту же позицию прочтения и метку изменения, что и в chat_members (см. V0008, V0015)
+ALTER TABLE chat_participants ADD COLUMN IF NOT EXISTS last_read_message_id BIGINT;
+ALTER TABLE chat_participants ADD COLUMN IF NOT EXISTS last_read_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE chat_participants ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE chat_participants ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+-- Существующая история считается прочитанной
+UPDATE chat_participants p
+SET last_read_message_id = s.last_message_id, last_read_count = s.message_count
+FROM chat_summaries s
+WHERE s.chat_id = p.chat_id;
+
+-- Единый источник членства в чатах для чтения; запись идёт в исходные таблицы
+CREATE OR REPLACE VIEW chat_memberships AS
+SELECT chat_id, user_id, last_read_message_id, last_read_count, change_xid
+FROM chat_members
+UNION ALL
+SELECT p.chat_id, p.user_id, p.last_read_message_id, p.last_read_count, p.change_xid
+FROM chat_participants p
+WHERE NOT EXISTS (SELECT 1 FROM chat_members m WHERE m.chat_id = p.chat_id AND m.user_id = p.user_id);
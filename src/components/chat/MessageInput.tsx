@@ -18,6 +18,55 @@ export interface AttachmentData {
 
 const UPLOAD_URL = 'https://functions.poehali.dev/e3d8c032-0124-4f9e-953b-cb8e70ed6cdb';
 
+const postUpload = async (body: Record<string, unknown>) => {
+  const response = await fetch(UPLOAD_URL, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body)
+  });
+  const data = await response.json();
+  if (!response.ok) {
+    throw new Error(data.error || 'Upload failed');
+  }
+  return data;
+};
+
+const toBase64 = (buffer: ArrayBuffer) => {
+  const bytes = new Uint8Array(buffer);
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binary += String.fromCharCode(...bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(binary);
+};
+
+const uploadInChunks = async (file: File) => {
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  const sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+
+  const init = await postUpload({
+    action: 'init',
+    name: file.name,
+    type: file.type,
+    size: file.size,
+    sha256
+  });
+  if (init.exists) {
+    return init;
+  }
+
+  const { upload_id, chunk_size } = init;
+
+  let offset = 0;
+  while (offset < file.size) {
+    const chunk = await file.slice(offset, offset + chunk_size).arrayBuffer();
+    const data = await postUpload({ action: 'append', upload_id, offset, chunk: toBase64(chunk) });
+    offset = data.received;
+  }
+
+  return postUpload({ action: 'finalize', upload_id });
+};
+
 export default function MessageInput({ onSendMessage, disabled }: MessageInputProps) {
   const [newMessage, setNewMessage] = useState('');
   const [sending, setSending] = useState(false);
@@ -36,35 +85,14 @@ export default function MessageInput({ onSendMessage, disabled }: MessageInputPr
 
     setUploading(true);
     try {
-      const reader = new FileReader();
-      reader.onload = async (event) => {
-        const base64 = event.target?.result as string;
-        
-        const response = await fetch(UPLOAD_URL, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            file: base64,
-            name: file.name,
-            type: file.type
-          })
-        });
-
-        const data = await response.json();
-        
-        if (response.ok && data.url) {
-          setAttachment({
-            url: data.url,
-            type: data.type,
-            name: data.name,
-            size: data.size
-          });
-          toast.success('Файл загружен');
-        } else {
-          toast.error('Ошибка загрузки файла');
-        }
-      };
-      reader.readAsDataURL(file);
+      const data = await uploadInChunks(file);
+      setAttachment({
+        url: data.url,
+        type: data.type,
+        name: data.name,
+        size: data.size
+      });
+      toast.success('Файл загружен');
     } catch (error) {
       toast.error('Ошибка загрузки файла');
     } finally {
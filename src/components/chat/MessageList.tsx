@@ -16,6 +16,8 @@ export interface Message {
   attachment_type?: string;
   attachment_name?: string;
   attachment_size?: number;
+  attachment_thumbnails?: Record<string, string>;
+  attachment_placeholder?: string;
 }
 
 interface MessageListProps {
@@ -95,8 +97,10 @@ export default function MessageList({ messages, userId, chatName }: MessageListP
                     <div className="p-2">
                       {isImage ? (
                         <img
-                          src={msg.attachment_url}
+                          src={msg.attachment_thumbnails?.['800'] || msg.attachment_url}
                           alt={msg.attachment_name}
+                          loading="lazy"
+                          style={msg.attachment_placeholder ? { backgroundImage: `url(${msg.attachment_placeholder})`, backgroundSize: 'cover' } : undefined}
                           className="max-w-full rounded-lg cursor-pointer hover:opacity-90 transition-opacity"
                           onClick={() => window.open(msg.attachment_url, '_blank')}
                         />
@@ -64,6 +64,8 @@ export default function Index() {
   const [newChatiks, setNewChatiks] = useState('');
   
   const messagesEndRef = useRef<HTMLDivElement>(null);
+  const lastMessageIdRef = useRef(0);
+  const [pollChatId, setPollChatId] = useState<number | null>(null);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -71,8 +73,44 @@ export default function Index() {
 
   useEffect(() => {
     scrollToBottom();
+    lastMessageIdRef.current = messages.length > 0 ? messages[messages.length - 1].id : 0;
   }, [messages]);
 
+  useEffect(() => {
+    if (!selectedChat || pollChatId !== selectedChat.id) return;
+    
+    let active = true;
+    const chatId = selectedChat.id;
+    
+    const listen = async () => {
+      while (active) {
+        try {
+          const response = await fetch(`${API_URL}?path=poll&chat_id=${chatId}&after_id=${lastMessageIdRef.current}`, {
+            headers: userId ? { 'X-User-Id': String(userId) } : undefined
+          });
+          if (response.status === 400) {
+            if (active) loadMessages(chatId);
+            return;
+          }
+          if (!response.ok) throw new Error(`Poll failed: ${response.status}`);
+          const data = await response.json();
+          const newMessages: Message[] = data.messages || [];
+          if (active && newMessages.length > 0) {
+            setMessages(prev => [...prev, ...newMessages.filter(m => !prev.some(p => p.id === m.id))]);
+          }
+        } catch (error) {
+          await new Promise(resolve => setTimeout(resolve, 3000));
+        }
+      }
+    };
+    
+    listen();
+    
+    return () => {
+      active = false;
+    };
+  }, [selectedChat?.id, pollChatId, userId]);
+
   useEffect(() => {
     if (!userId) return;
     
@@ -210,11 +248,16 @@ export default function Index() {
   }, [userId, isAuthenticated]);
 
   const loadMessages = async (chatId: number) => {
+    setPollChatId(null);
     try {
-      const response = await fetch(`${API_URL}?path=messages&chat_id=${chatId}`);
+      const response = await fetch(`${API_URL}?path=messages&chat_id=${chatId}`, {
+        headers: userId ? { 'X-User-Id': String(userId) } : undefined
+      });
       const data = await response.json();
       if (data.messages) {
         setMessages(data.messages);
+        lastMessageIdRef.current = data.messages.length > 0 ? data.messages[data.messages.length - 1].id : 0;
+        setPollChatId(chatId);
       }
     } catch (error) {
       console.error('Error loading messages:', error);
@@ -251,10 +294,6 @@ export default function Index() {
       if (response.ok && data.message) {
         setMessages(prev => [...prev, data.message]);
         
-        if (data.ai_reply) {
-          setMessages(prev => [...prev, data.ai_reply]);
-        }
-        
         loadChats(userId);
       }
     } catch (error) {